@@ -0,0 +1,61 @@
+# Memory per queued job, compared with the task dicts the bot used to queue (each held the Update and the context of its
+# request and the parameters shared by all images of the request).
+# Run from the repository root (next to config.yaml): python -m benchmarks.job_memory
+import time
+import tracemalloc
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+
+from comfyui_telegram_bot import config
+from comfyui_telegram_bot.image_gen import GenerationParameters
+from comfyui_telegram_bot.job_store import Job
+
+# a queued job may not take more than this, without its prompt (Telegram messages are at most 4096 characters)
+JOB_MEMORY_BUDGET = 1024
+REQUESTS = 1000
+MESSAGE = "A futuristic city skyline at night with flying cars and neon lights 21:9 2MP 4x"
+
+application = Application.builder().token("123456:benchmark").build()
+
+
+def receive_update(i: int) -> Update:
+    user = {"id": 100000 + i, "is_bot": False, "first_name": "Ada", "last_name": "Lovelace", "username": "ada", "language_code": "en"}
+    message = {"message_id": i, "date": int(time.time()), "text": MESSAGE, "from": user,
+               "chat": {"id": user["id"], "type": "private", "first_name": "Ada", "last_name": "Lovelace", "username": "ada"}}
+    return Update.de_json({"update_id": i, "message": message}, application.bot)
+
+
+def legacy_request(i: int) -> list:
+    update = receive_update(i)
+    context = CallbackContext.from_update(update, application)
+    params = GenerationParameters.from_message(update.effective_user.id, update.message.text, config.image_generation)
+    return [{'update': update, 'context': context, 'cancel': False, 'running': False, 'params': params}
+            for _ in range(params.batch_size)]
+
+
+def request(i: int) -> list:
+    update = receive_update(i)
+    params = GenerationParameters.from_message(update.effective_user.id, update.message.text, config.image_generation)
+    return [Job(i, update.effective_chat.id, update.message.message_id, job_params)
+            for job_params in params.split_jobs([1] * params.batch_size)]
+
+
+def measure(queue_request) -> float:
+    queue_request(0) # caches filled on first use are not counted
+    tracemalloc.start()
+    queues = [queue_request(i) for i in range(REQUESTS)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / sum(len(jobs) for jobs in queues)
+
+
+def main():
+    sizes = {"task dict": measure(legacy_request), "job": measure(request)}
+    for name, size in sizes.items():
+        print(f"{name:>9}: {size:.0f} bytes per queued job")
+    assert sizes["job"] <= JOB_MEMORY_BUDGET, "a queued job takes more memory than its budget"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Per-message cost of parsing generation requests, compared with the previous regex based parser.
+# Run from the repository root (next to config.yaml): python -m benchmarks.param_parser
+import re
+import timeit
+
+from comfyui_telegram_bot.param_parser import parse_message, parse_messages
+
+CORPUS = [
+    "A landscape with mountains 1920x1080 2x",
+    "A man in a red t-shirt 2MP pe=default m=real",
+    "A cat sitting on a windowsill at sunset",
+    "A winter landscape with a frozen lake and pine trees 16:9 4x s=30 cfg=2.5",
+    "portrait of an old fisherman, dramatic lighting 3:4 1.5MP seed=123456789",
+    "A sign with a large red X on a white background, below text saying 'ERROR'. 1024x1024",
+    "A futuristic city skyline at night with flying cars and neon lights m=paint 21:9 2MP 3x pe=default",
+    "Astronaut riding a horse on the moon s=25",
+    "A bowl of ramen with a soft boiled egg, steam rising, studio photo 4:5 cfg=3 seed=42 2x",
+    "watercolor painting of a lighthouse in a storm m=paint",
+    "A cozy library with tall bookshelves and a fireplace, warm light, highly detailed 1536x1024 s=40 cfg=3.5 pe=default",
+    "minimalist logo of a fox",
+]
+
+LEGACY_PATTERNS = {
+    "size": {"pattern": r'(\d+)x(\d+)', "type": int, "num_params": 2},
+    "ratio": {"pattern": r'(\d+\.?\d*):(\d+\.?\d*)', "type": float, "num_params": 2},
+    "mp_count": {"pattern": r'(\d+\.?\d*)MP', "type": float, "num_params": 1},
+    "batch_size": {"pattern": r'(\d+)x', "type": int, "num_params": 1},
+    "steps": {"pattern": r's=(\d+)', "type": int, "num_params": 1},
+    "cfg": {"pattern": r'cfg=(\d+\.?\d*)', "type": float, "num_params": 1},
+    "mode": {"pattern": r'm=([a-zA-Z]+)', "type": str, "num_params": 1},
+    "seed": {"pattern": r'seed=(\d+)', "type": int, "num_params": 1},
+    "prompt_enhance": {"pattern": r'pe=([\w]+)', "type": str, "num_params": 1},
+}
+
+
+def legacy_parse_message(message):
+    # the parser used before param_parser.py, kept as the baseline of the benchmark
+    combined_pattern = '|'.join(fr"\b{info['pattern']}\b" for info in LEGACY_PATTERNS.values())
+    all_matches = list(re.finditer(combined_pattern, message))
+    if not all_matches:
+        return message.strip(), {}
+    params = message[all_matches[0].start():]
+    result_params = {}
+    for param_name, info in LEGACY_PATTERNS.items():
+        for param_match in re.finditer(fr"\b{info['pattern']}\b", params):
+            if info['num_params'] == 1:
+                result_params[param_name] = info['type'](param_match.group(1))
+            else:
+                result_params[param_name] = tuple(map(info['type'], param_match.groups()))
+    for match in all_matches:
+        message = message.replace(match.group(), '', 1)
+    return message.strip(), result_params
+
+
+def main():
+    repeat = 2000
+    for message in CORPUS:
+        parsed = parse_message(message)
+        assert (parsed.prompt, parsed.params) == legacy_parse_message(message), message
+
+    messages = CORPUS * repeat
+    for name, parse in [("legacy", lambda: [legacy_parse_message(message) for message in messages]),
+                        ("single pass", lambda: [parse_message(message) for message in messages]),
+                        ("single pass (batch)", lambda: parse_messages(messages))]:
+        seconds = min(timeit.repeat(parse, number=1, repeat=5))
+        print(f"{name:>20}: {seconds / len(messages) * 1e6:.2f} us per message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import asyncio
+import time
+from typing import Hashable, List, Optional, Set, Tuple, Union
+
+import httpx
+
+from .config import BackendConfig, ComfyUIClientConfig, ImageGenerationConfig
+from .comfyui_client import ComfyUIClient, CONNECT_ERRORS
+from .comfyui_websocket import ComfyUIWebsocket
+from . import logger
+
+
+class ComfyUIBackend:
+    def __init__(self, config: BackendConfig, client_config: ComfyUIClientConfig, client_id: Optional[str] = None):
+        self.config = config
+        self.client_config = client_config
+        self.name = config.server_url
+        self.client = ComfyUIClient(config.server_url, client_config)
+        self.websocket = ComfyUIWebsocket(config.websocket_url, client_config, on_status=self._on_status, client_id=client_id)
+        self.queue_depth = 0 # running and pending prompts of all ComfyUI clients, as last reported by the server
+        self.submitted_since_update = 0 # prompts submitted by the bot since queue_depth was last reported
+        self.vram_free_ratio = 1.0
+        self.failures = 0
+        self.drained_until = 0.0
+        self.lora_key: Hashable = None # LoRA of the last submitted prompt, the one ComfyUI will have loaded
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.drained_until
+
+    @property
+    def available(self) -> bool:
+        return self.healthy and self.websocket.connected
+
+    @property
+    def load(self) -> float:
+        return (self.queue_depth + self.submitted_since_update) / self.config.weight
+
+    def record_submit(self) -> None:
+        self.submitted_since_update += 1
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self, error: Exception) -> None:
+        self.failures += 1
+        logger.warning(f"ComfyUI backend {self.name} failed ({self.failures}/{self.client_config.max_failures}): {error!r}")
+        if self.failures >= self.client_config.max_failures:
+            logger.error(f"Draining ComfyUI backend {self.name} for {self.client_config.drain_duration}s")
+            self.drained_until = time.monotonic() + self.client_config.drain_duration
+            self.failures = 0
+
+    async def check_health(self) -> None:
+        try:
+            queue = await self.client.get_queue()
+            stats = await self.client.get_system_stats()
+        except Exception as e:
+            self.record_failure(e)
+            return
+        self.record_success()
+        self._update_queue_depth(len(queue.get("queue_running", [])) + len(queue.get("queue_pending", [])))
+        devices = [device for device in stats.get("devices", []) if device.get("vram_total")]
+        if devices:
+            self.vram_free_ratio = min(device["vram_free"] / device["vram_total"] for device in devices)
+
+    def _on_status(self, status: dict) -> None:
+        queue_remaining = status.get("exec_info", {}).get("queue_remaining")
+        if queue_remaining is not None:
+            self._update_queue_depth(queue_remaining)
+
+    def _update_queue_depth(self, queue_depth: int) -> None:
+        self.queue_depth = queue_depth
+        self.submitted_since_update = 0
+
+    async def close(self) -> None:
+        await self.websocket.close()
+        await self.client.close()
+
+
+class ComfyUIBackendPool:
+    def __init__(self, config: ImageGenerationConfig, client_id: Optional[str] = None):
+        self.config = config
+        self.backends = [ComfyUIBackend(backend_config, config.client, client_id) for backend_config in config.get_backends()]
+        self._health_task: Optional[asyncio.Task] = None
+        self.lora_reloads = 0
+        self.lora_reloads_avoided = 0
+
+    @property
+    def lora_reload_avoidance_rate(self) -> float:
+        total = self.lora_reloads + self.lora_reloads_avoided
+        return self.lora_reloads_avoided / total if total else 0.0
+
+    @property
+    def available_count(self) -> int:
+        return sum(1 for backend in self.backends if backend.available)
+
+    def loaded_lora_keys(self) -> Set[Hashable]:
+        return {backend.lora_key for backend in self.backends if backend.available}
+
+    def get(self, name: str) -> Optional[ComfyUIBackend]:
+        return next((backend for backend in self.backends if backend.name == name), None)
+
+    def start(self) -> None:
+        for backend in self.backends:
+            backend.websocket.start()
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._check_health())
+
+    async def close(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        for backend in self.backends:
+            await backend.close()
+
+    async def select(self, lora_key: Hashable = None, exclude: List[ComfyUIBackend] = ()) -> ComfyUIBackend:
+        deadline = time.monotonic() + self.config.client.connect_timeout
+        while True:
+            available = [backend for backend in self.backends if backend.available and backend not in exclude]
+            if available:
+                # least loaded first, more free VRAM breaks ties
+                least_loaded = min(available, key=lambda backend: (backend.load, -backend.vram_free_ratio))
+                # a slightly more loaded backend is still faster if it does not have to load a different LoRA
+                max_load = least_loaded.load + self.config.client.lora_affinity_max_extra_load
+                same_lora = [backend for backend in available if backend.lora_key == lora_key and backend.load <= max_load]
+                if least_loaded.lora_key != lora_key and same_lora:
+                    return min(same_lora, key=lambda backend: (backend.load, -backend.vram_free_ratio))
+                return least_loaded
+            candidates = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+            timeout = deadline - time.monotonic()
+            if not candidates or timeout <= 0:
+                raise Exception("No ComfyUI server is available at the moment, please try again later.")
+            # right after startup or a lost connection, wait until a websocket is connected
+            waiters = [asyncio.create_task(backend.websocket.wait_connected(timeout)) for backend in candidates]
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+
+    async def submit(self, workflow: Union[dict, str], lora_key: Hashable = None) -> Tuple[ComfyUIBackend, str]:
+        tried = []
+        while True:
+            backend = await self.select(lora_key, exclude=tried)
+            try:
+                prompt_id = await backend.client.queue_prompt(workflow, backend.websocket.client_id)
+            except (*CONNECT_ERRORS, httpx.HTTPStatusError) as e:
+                # the backend is unreachable or broken, the prompt can be sent to another one
+                backend.record_failure(e)
+                tried.append(backend)
+                if len(tried) == len(self.backends):
+                    raise Exception("Failed to submit the generation to ComfyUI, please try again later.")
+                continue
+            except httpx.HTTPError as e:
+                # the prompt might have been queued, resubmitting it could run it twice
+                backend.record_failure(e)
+                raise
+            backend.record_success()
+            backend.record_submit()
+            if backend.lora_key == lora_key:
+                self.lora_reloads_avoided += 1
+            else:
+                self.lora_reloads += 1
+                backend.lora_key = lora_key
+            return backend, prompt_id
+
+    async def _check_health(self) -> None:
+        while True:
+            await asyncio.gather(*(backend.check_health() for backend in self.backends))
+            loads = ", ".join(f"{backend.name}: {backend.load:.1f}{'' if backend.available else ' (unavailable)'}" for backend in self.backends)
+            logger.debug(f"ComfyUI backend loads - {loads}, LoRA reload avoidance rate: {self.lora_reload_avoidance_rate:.0%} "
+                         f"({self.lora_reloads_avoided} avoided, {self.lora_reloads} reloads)")
+            await asyncio.sleep(self.config.client.health_check_interval)
@@ -0,0 +1,107 @@
+import asyncio
+import json
+from typing import Any, Dict, List, Optional, Union
+
+import httpx
+
+from .config import ComfyUIClientConfig
+from . import logger
+
+# errors raised before the request reached the server, safe to retry even for non-idempotent requests
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class ComfyUIClient:
+    def __init__(self, server_url: str, config: ComfyUIClientConfig):
+        self.server_url = server_url.rstrip("/")
+        self.config = config
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # created lazily so that the connection pool is bound to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.server_url,
+                limits=httpx.Limits(
+                    max_connections=self.config.max_connections,
+                    max_keepalive_connections=self.config.max_connections,
+                    keepalive_expiry=self.config.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(self.config.queue_timeout, connect=self.config.connect_timeout),
+            )
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method: str, path: str, timeout: float, idempotent: bool = True, **kwargs) -> httpx.Response:
+        delay = self.config.retry_delay
+        for attempt in range(self.config.retries + 1):
+            try:
+                response = await self.client.request(method, path, timeout=httpx.Timeout(timeout, connect=self.config.connect_timeout), **kwargs)
+                if response.status_code < 500 or not idempotent:
+                    return response
+                error = Exception(f"ComfyUI responded with status {response.status_code} to {method} {path}")
+            except CONNECT_ERRORS as e:
+                error = e
+            except httpx.TransportError as e:
+                if not idempotent:
+                    raise
+                error = e
+            if attempt == self.config.retries:
+                raise error
+            logger.warning(f"Request {method} {path} failed (attempt {attempt + 1}). Error: {error!r} Retrying...")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def queue_prompt(self, workflow: Union[Dict[str, Any], str], client_id: str) -> str:
+        if isinstance(workflow, str):
+            # an already serialized workflow is spliced into the request body
+            content = f'{{"prompt": {workflow}, "client_id": {json.dumps(client_id)}}}'
+            response = await self._request("POST", "/prompt", self.config.prompt_timeout, idempotent=False,
+                                           content=content, headers={"Content-Type": "application/json"})
+        else:
+            response = await self._request("POST", "/prompt", self.config.prompt_timeout, idempotent=False,
+                                           json={"prompt": workflow, "client_id": client_id})
+        if response.status_code >= 500:
+            response.raise_for_status()
+        data = response.json()
+        if response.status_code != 200 or "prompt_id" not in data:
+            error = data.get("error", {})
+            message = error.get("message", response.text) if isinstance(error, dict) else error
+            raise Exception(f"ComfyUI rejected the prompt: {message}")
+        return data["prompt_id"]
+
+    async def get_history(self, prompt_id: str) -> Dict[str, Any]:
+        response = await self._request("GET", f"/history/{prompt_id}", self.config.history_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_image(self, filename: str, subfolder: str = "", folder_type: str = "output") -> bytes:
+        response = await self._request("GET", "/view", self.config.view_timeout,
+                                       params={"filename": filename, "subfolder": subfolder, "type": folder_type})
+        response.raise_for_status()
+        return response.content
+
+    async def get_queue(self) -> Dict[str, Any]:
+        response = await self._request("GET", "/queue", self.config.queue_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_system_stats(self) -> Dict[str, Any]:
+        response = await self._request("GET", "/system_stats", self.config.queue_timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def interrupt(self, prompt_id: Optional[str] = None) -> None:
+        # with a prompt_id ComfyUI only interrupts that prompt (older versions ignore it and interrupt whatever is running)
+        kwargs = {"json": {"prompt_id": prompt_id}} if prompt_id is not None else {}
+        response = await self._request("POST", "/interrupt", self.config.queue_timeout, **kwargs)
+        logger.debug(f"Interrupt response: {response.status_code} {response.text}")
+
+    async def delete_queued(self, prompt_ids: List[str]) -> None:
+        response = await self._request("POST", "/queue", self.config.queue_timeout, json={"delete": prompt_ids})
+        logger.debug(f"Queue delete response: {response.status_code} {response.text}")
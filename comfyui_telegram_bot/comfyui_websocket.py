@@ -0,0 +1,130 @@
+import asyncio
+from collections import OrderedDict
+import json
+from typing import Any, Callable, Dict, Optional
+import uuid
+
+import websockets
+
+from .config import ComfyUIClientConfig
+from . import logger
+
+FINISHED_MESSAGE_TYPES = ("execution_success", "execution_error", "execution_interrupted")
+
+
+class ComfyUIWebsocket:
+    # messages received for prompts nobody is subscribed to yet (the prompt may start executing
+    # before the /prompt response arrives), kept for at most this many prompts
+    MAX_BACKLOG_PROMPTS = 32
+    MAX_BACKLOG_MESSAGES = 100
+
+    def __init__(self, websocket_url: str, config: ComfyUIClientConfig, on_status: Optional[Callable[[dict], None]] = None,
+                 client_id: Optional[str] = None):
+        self.websocket_url = websocket_url
+        self.config = config
+        self.on_status = on_status
+        self.client_id = client_id or uuid.uuid4().hex
+        self._subscribers: Dict[str, asyncio.Queue] = {}
+        self._backlog: OrderedDict[str, list] = OrderedDict()
+        self._executing_prompt_id: Optional[str] = None
+        self._connected = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._connected.clear()
+
+    async def wait_connected(self, timeout: float) -> None:
+        self.start()
+        try:
+            await asyncio.wait_for(self._connected.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise Exception("Could not connect to the ComfyUI server, please try again later.")
+
+    def subscribe(self, prompt_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        for message in self._backlog.pop(prompt_id, []):
+            queue.put_nowait(message)
+        self._subscribers[prompt_id] = queue
+        return queue
+
+    def unsubscribe(self, prompt_id: str, queue: asyncio.Queue) -> None:
+        # a queue that was replaced by a newer subscription (e.g. after reattaching) is not unsubscribed twice
+        if self._subscribers.get(prompt_id) is queue:
+            del self._subscribers[prompt_id]
+            self._backlog.pop(prompt_id, None)
+
+    async def _run(self) -> None:
+        delay = self.config.websocket_reconnect_delay
+        reconnecting = False
+        while True:
+            try:
+                async with websockets.connect(f"{self.websocket_url}?clientId={self.client_id}", max_size=None,
+                                              open_timeout=self.config.connect_timeout) as websocket:
+                    logger.info("Connected to the ComfyUI websocket")
+                    self._connected.set()
+                    delay = self.config.websocket_reconnect_delay
+                    if reconnecting:
+                        self._notify_reconnected()
+                    async for message in websocket:
+                        self._dispatch(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI websocket connection lost ({e!r}), reconnecting in {delay}s")
+            else:
+                logger.warning(f"ComfyUI websocket connection closed, reconnecting in {delay}s")
+            self._connected.clear()
+            self._executing_prompt_id = None
+            reconnecting = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.config.websocket_max_reconnect_delay)
+
+    def _notify_reconnected(self) -> None:
+        # messages sent while disconnected are lost, subscribers have to check the prompt state themselves
+        for prompt_id, queue in self._subscribers.items():
+            queue.put_nowait({"type": "reconnected", "data": {"prompt_id": prompt_id}})
+
+    def _dispatch(self, message: Any) -> None:
+        if isinstance(message, str):
+            logger.debug(f"ws Message: {message}")
+            data = json.loads(message)
+            if data["type"] == "status" and self.on_status is not None:
+                self.on_status(data["data"].get("status", {}))
+            prompt_id = data.get("data", {}).get("prompt_id")
+            if prompt_id is None:
+                return
+            finished = data["type"] in FINISHED_MESSAGE_TYPES or (data["type"] == "executing" and data["data"].get("node") is None)
+            if data["type"] in ("execution_start", "executing") and not finished:
+                self._executing_prompt_id = prompt_id
+            self._route(prompt_id, data)
+            if finished and self._executing_prompt_id == prompt_id:
+                self._executing_prompt_id = None
+        elif self._executing_prompt_id is not None:
+            # binary messages (previews) carry no prompt id, they belong to the prompt currently executing
+            self._route(self._executing_prompt_id, message)
+
+    def _route(self, prompt_id: str, message: Any) -> None:
+        queue = self._subscribers.get(prompt_id)
+        if queue is not None:
+            queue.put_nowait(message)
+            return
+        backlog = self._backlog.setdefault(prompt_id, [])
+        if len(backlog) < self.MAX_BACKLOG_MESSAGES:
+            backlog.append(message)
+        while len(self._backlog) > self.MAX_BACKLOG_PROMPTS:
+            self._backlog.popitem(last=False)
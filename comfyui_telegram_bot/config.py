@@ -1,6 +1,7 @@
 from dataclasses import dataclass, field
-from typing import Dict, Optional, Any, Type, TypeVar, get_type_hints
+from typing import Dict, List, Optional, Any, Type, TypeVar, get_type_hints
 from pathlib import Path
+import math
 import yaml
 
 T = TypeVar('T')
@@ -26,6 +27,8 @@ class BaseConfig:
                 kwargs[field_name] = {
                     k: ModeConfig.from_dict(v) for k, v in field_value.items()
                 }
+            elif field_name == "backends" and isinstance(field_value, list):
+                kwargs[field_name] = [BackendConfig.from_dict(v) for v in field_value]
             elif field_name == "types" and isinstance(field_value, dict):
                 kwargs[field_name] = {
                     k: PromptEnhanceTypeConfig.from_dict(v) for k, v in field_value.items()
@@ -44,6 +47,13 @@ class PromptEnhanceTypeConfig(BaseConfig):
     description: str
     system_prompt: str
 
+@dataclass
+class PromptCacheConfig(BaseConfig):
+    enabled: bool = True
+    memory_entries: int = 256
+    filepath: Optional[str] = "prompt_cache.sqlite3"
+    max_disk_entries: int = 10000
+
 @dataclass
 class PromptEnhanceConfig(BaseConfig):
     service: str
@@ -53,10 +63,23 @@ class PromptEnhanceConfig(BaseConfig):
     temperature: float
     types: Dict[str, PromptEnhanceTypeConfig]
     retries: int
+    max_concurrent_requests: int = 2
+    timeout: float = 60.0
+    retry_delay: float = 1.0
+    retry_max_delay: float = 30.0
+    cache: PromptCacheConfig = field(default_factory=PromptCacheConfig)
+
+@dataclass
+class StatusUpdatesConfig(BaseConfig):
+    max_edits_per_second: float = 20.0 # for all chats together
+    chat_interval: float = 1.0 # seconds between edits in the same chat
+    min_preview_interval: float = 2.0 # seconds between previews of the same generation
+    retries: int = 3 # when Telegram responds with RetryAfter to a final update or another message of a job
 
 @dataclass
 class TelegramBotConfig(BaseConfig):
     token: str
+    status_updates: StatusUpdatesConfig = field(default_factory=StatusUpdatesConfig)
 
 @dataclass
 class ModeConfig(BaseConfig):
@@ -74,29 +97,148 @@ class ModeConfig(BaseConfig):
     def get_defaults(cls) -> 'ModeConfig':
         return cls()
 
+@dataclass
+class ComfyUIClientConfig(BaseConfig):
+    max_connections: int = 10
+    keepalive_expiry: float = 30.0
+    connect_timeout: float = 5.0
+    prompt_timeout: float = 10.0
+    history_timeout: float = 10.0
+    view_timeout: float = 60.0
+    queue_timeout: float = 10.0
+    retries: int = 3
+    retry_delay: float = 0.5
+    websocket_reconnect_delay: float = 1.0
+    websocket_max_reconnect_delay: float = 30.0
+    health_check_interval: float = 5.0
+    max_failures: int = 3
+    drain_duration: float = 60.0
+    lora_affinity_max_extra_load: float = 1.0
+
+@dataclass
+class PreviewConfig(BaseConfig):
+    max_bytes: int = 150_000 # larger previews are downscaled and re-encoded as JPEG
+    max_pixels: int = 512 * 512
+    jpeg_quality: int = 80
+    min_jpeg_quality: int = 35
+    workers: int = 2
+
+@dataclass
+class BackendConfig(BaseConfig):
+    server_url: str
+    websocket_url: str
+    weight: float = 1.0
+
+DEFAULT_WORKFLOW_BINDINGS = {
+    "prompt": ["6", "text"],
+    "seed": ["25", "noise_seed"],
+    "width": ["27", "width"],
+    "height": ["27", "height"],
+    "batch_size": ["27", "batch_size"],
+    "cfg": ["26", "guidance"],
+    "sampler": ["16", "sampler_name"],
+    "scheduler": ["17", "scheduler"],
+    "steps": ["17", "steps"],
+    "lora": ["55", "lora_name"],
+    "lora_strength": ["55", "strength_model"],
+    "model": ["54", "unet_name"],
+    "vae": ["10", "vae_name"],
+    "clip_t5": ["11", "clip_name1"],
+    "clip_l": ["11", "clip_name2"],
+}
+
+@dataclass
+class WorkflowConfig(BaseConfig):
+    # inputs set by the bot as [node id, input name], bindings that are not configured keep their default
+    bindings: Dict[str, Optional[List[str]]] = field(default_factory=dict)
+    lora_node: Optional[str] = "55"
+    save_image_node: Optional[str] = "52"
+    preview_image_node: Optional[str] = "59"
+    websocket_image_node: Optional[str] = "60"
+
+    def __post_init__(self):
+        self.bindings = {**DEFAULT_WORKFLOW_BINDINGS, **self.bindings}
+
+@dataclass
+class RuntimeEstimateConfig(BaseConfig):
+    seconds_per_megapixel_step: float = 0.5 # used until durations of generations were observed
+    overhead: float = 2.0 # seconds per generation independent of its size and steps (e.g. text encoding, VAE decode)
+    smoothing: float = 0.05 # weight of a new observation, older ones are forgotten gradually
+
+@dataclass
+class ResultCacheConfig(BaseConfig):
+    enabled: bool = True
+    max_bytes: int = 64 * 1024 * 1024 # images that were not sent yet count with their size, sent images only with their Telegram file_id
+    max_entries: int = 1024
+
 @dataclass
 class ImageGenerationConfig(BaseConfig):
     model: str
     vae: str
     clip_t5: str
     clip_l: str
-    server_url: str
-    websocket_url: str
     workflow_filepath: Path
     save_images: bool
     placeholder_image_font_filepath: Path
     update_preview_every_n_steps: int
     modes: Dict[str, ModeConfig] = field(default_factory=dict)
+    output_mode: str = "history"
+    latent_batching: bool = False
+    max_latent_batch_size: int = 4
+    max_batch_size: int = 10 # images per request
+    max_megapixel_steps: float = 800 # per request, megapixels x steps x images
+    client: ComfyUIClientConfig = field(default_factory=ComfyUIClientConfig)
+    workflow: WorkflowConfig = field(default_factory=WorkflowConfig)
+    previews: PreviewConfig = field(default_factory=PreviewConfig)
+    result_cache: ResultCacheConfig = field(default_factory=ResultCacheConfig)
+    runtime_estimate: RuntimeEstimateConfig = field(default_factory=RuntimeEstimateConfig)
+    server_url: Optional[str] = None
+    websocket_url: Optional[str] = None
+    backends: List[BackendConfig] = field(default_factory=list)
 
     def get_mode_config_defaults(self) -> ModeConfig:
         return self.modes.get("default", ModeConfig())
 
+    def get_backends(self) -> List[BackendConfig]:
+        if self.backends:
+            return self.backends
+        if self.server_url is None or self.websocket_url is None:
+            raise ValueError("Either 'backends' or 'server_url' and 'websocket_url' have to be configured")
+        return [BackendConfig(server_url=self.server_url, websocket_url=self.websocket_url)]
+
+@dataclass
+class QueueConfig(BaseConfig):
+    policy: str = "round_robin"
+    max_active_tasks: Optional[int] = None # derived from the backends if not set
+    max_active_tasks_per_user: int = 2
+    user_weights: Dict[int, float] = field(default_factory=dict)
+    affinity_window: int = 4
+    max_wait: float = 600 # seconds, with the "shortest_first" policy tasks that waited longer are started first (oldest first)
+    max_tasks_per_user: int = 20 # pending and in progress, requests above it are rejected
+    max_tasks: int = 200 # of all users
+    max_queued_gpu_seconds: Optional[float] = None # expected GPU time of all tasks, requests above it are rejected (no limit if not set)
+    store_filepath: str = "jobs.sqlite3" # SQLite database of the queued jobs, they are resumed after a restart
+
+@dataclass
+class MetricsConfig(BaseConfig):
+    enabled: bool = False # serves the metrics in the Prometheus text format on http://host:port/metrics
+    host: str = "127.0.0.1"
+    port: int = 9464
+
 @dataclass
 class Config(BaseConfig):
     prompt_enhancement: PromptEnhanceConfig
     telegram_bot: TelegramBotConfig
     image_generation: ImageGenerationConfig
     logger: LoggerConfig
+    queue: QueueConfig = field(default_factory=QueueConfig)
+    metrics: MetricsConfig = field(default_factory=MetricsConfig)
+
+    def __post_init__(self):
+        if self.queue.max_active_tasks is None:
+            # two tasks per server keep its GPU busy while the result of the previous task is sent,
+            # servers with a higher weight get more tasks
+            self.queue.max_active_tasks = sum(max(2, math.ceil(2 * backend.weight)) for backend in self.image_generation.get_backends())
 
     @classmethod
     def from_yaml(cls, path: Path | str) -> 'Config':
@@ -1,21 +1,32 @@
-from dataclasses import dataclass
-import re
-from typing import Tuple, Dict, Any, Optional
+from dataclasses import dataclass, field, replace
+from collections import OrderedDict
+from pathlib import Path
+from typing import Tuple, Dict, Any, Callable, Iterable, List, Optional, Union
+import hashlib
 import math
 import random
+import time
 from PIL import Image, ImageDraw, ImageFont
-from copy import deepcopy
 import json
-import websockets
 import asyncio
 import io
-import os
-import requests
 
 from .config import ImageGenerationConfig, ModeConfig
+from .backends import ComfyUIBackend, ComfyUIBackendPool
+from .workflow_template import WorkflowTemplate, compile_workflow
+from .status_updates import StatusUpdater
+from .previews import PreviewEncoder, parse_preview_frame
+from .job_store import Job
+from .result_cache import CachedImage, ResultCache
+from .runtime_estimator import RuntimeEstimator
+from .metrics import metrics
+from .param_parser import ParameterError, ParsedMessage, parse_message, parse_messages
 from . import logger
 
-@dataclass
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+PLACEHOLDER_CACHE_SIZE = 32
+
+@dataclass(slots=True)
 class GenerationParameters:
     user_id: int
     prompt: str
@@ -34,10 +45,22 @@ class GenerationParameters:
     prompt_enhance: Optional[str]
     prompt_template_pre_pe: str
     prompt_template_post_pe: str
+    latent_batch_size: int = 1 # images generated together in one ComfyUI workflow
 
     @classmethod
     def from_message(cls, user_id: int, message: str, config: ImageGenerationConfig) -> 'GenerationParameters':
-        prompt, params = cls._extract_parameters(message)
+        return cls.from_parsed_message(user_id, parse_message(message), config)
+
+    @classmethod
+    def from_messages(cls, messages: Iterable[Tuple[int, str]], config: ImageGenerationConfig) -> List['GenerationParameters']:
+        # (user id, message) pairs, e.g. when replaying stored requests
+        messages = list(messages)
+        parsed_messages = parse_messages(text for _, text in messages)
+        return [cls.from_parsed_message(user_id, parsed, config) for (user_id, _), parsed in zip(messages, parsed_messages)]
+
+    @classmethod
+    def from_parsed_message(cls, user_id: int, parsed: ParsedMessage, config: ImageGenerationConfig) -> 'GenerationParameters':
+        prompt, params = parsed.prompt, dict(parsed.params)
 
         mp_count = params.pop("mp_count", 1)
         if "ratio" in params:
@@ -55,10 +78,18 @@ class GenerationParameters:
         elif mode in config.modes:
             mode_config = config.modes[mode]
         else:
-            raise Exception(f"Invalid mode {mode}")
+            raise ParameterError(f"Invalid mode {mode}", parsed.positions["mode"])
         
         cfg = params.get("cfg", mode_config.cfg)
         steps = params.get("steps", mode_config.steps)
+
+        # requests that would occupy the GPU for too long are not accepted
+        if batch_size > config.max_batch_size:
+            raise ParameterError(f"Batch size {batch_size} is larger than the maximum of {config.max_batch_size}", parsed.positions["batch_size"])
+        megapixel_steps = width * height / (1024 * 1024) * steps * batch_size
+        if megapixel_steps > config.max_megapixel_steps:
+            raise ParameterError(f"The request is too large ({width}x{height}, {steps} steps, {batch_size} image(s)), "
+                                 f"lower the size, steps or batch size (megapixels x steps x images: {megapixel_steps:.0f}, at most {config.max_megapixel_steps:g})")
         seed = params.get("seed")
         is_set_seed = seed is not None
         prompt_enhance = params.get("prompt_enhance")
@@ -83,86 +114,6 @@ class GenerationParameters:
             prompt_template_post_pe=mode_config.prompt_template_post_pe
         )
 
-    @staticmethod
-    def _extract_parameters(message: str) -> Tuple[str, Dict[str, Any]]:
-        patterns = {
-            "size": {
-                "pattern": r'(\d+)x(\d+)',
-                "type": int,
-                "num_params": 2
-            },
-            "ratio": {
-                "pattern": r'(\d+\.?\d*):(\d+\.?\d*)',
-                "type": float,
-                "num_params": 2
-            },
-            "mp_count": {
-                "pattern": r'(\d+\.?\d*)MP',
-                "type": float,
-                "num_params": 1
-            },
-            "batch_size": {
-                "pattern": r'(\d+)x',
-                "type": int,
-                "num_params": 1
-            },
-            "steps": {
-                "pattern": r's=(\d+)',
-                "type": int,
-                "num_params": 1
-            },
-            "cfg": {
-                "pattern": r'cfg=(\d+\.?\d*)',
-                "type": float,
-                "num_params": 1
-            },
-            "mode": {
-                "pattern": r'm=([a-zA-Z]+)',
-                "type": str,
-                "num_params": 1
-            },
-            "seed": {
-                "pattern": r'seed=(\d+)',
-                "type": int,
-                "num_params": 1
-            },
-            "prompt_enhance": {
-                "pattern": r'pe=([\w]+)',
-                "type": str,
-                "num_params": 1
-            }
-        }
-
-        combined_pattern = '|'.join(fr"\b{info['pattern']}\b" for info in patterns.values())
-        
-        all_matches = list(re.finditer(combined_pattern, message))
-        if not all_matches:
-            return message.strip(), {}
-        
-        params_start = all_matches[0].start()
-        
-        prompt = message[:params_start].strip()
-        params = message[params_start:]
-        
-        result_params = {}
-        for param_name, info in patterns.items():
-            param_matches = list(re.finditer(fr"\b{info['pattern']}\b", params))
-            for param_match in param_matches:
-                match info['num_params']:
-                    case 1:
-                        result_params[param_name] = info['type'](param_match.group(1))
-                    case 2:
-                        result_params[param_name] = tuple(map(info['type'], param_match.groups()))
-                    case _:
-                        raise ValueError(f"Unexpected number of parameters for {param_name}")
-        
-        # remove matches from prompt
-        for match in all_matches:
-            message = message.replace(match.group(), '', 1)
-        prompt = message.strip()
-        
-        return prompt, result_params
-    
     @staticmethod
     def _calculate_resolution(width_ratio, height_ratio, area_mp):
         area_pixels = area_mp * 1024 * 1024
@@ -187,15 +138,35 @@ class GenerationParameters:
 
         return int(width), int(height)
     
+    def lora_key(self) -> Optional[Tuple[str, float]]:
+        # jobs with the same key can run one after another without ComfyUI re-patching the model
+        return (self.lora, self.lora_strength) if self.lora else None
+
     def update_prompt(self, prompt):
         self.prompt = prompt
 
     def update_before_generation(self):
-        if not self.is_set_seed: # randomize seed if not set by user
+        if self.seed is None: # randomize seed if not set by user (or when the job was queued)
             self.seed = random.randint(0, 2**32 - 1)
     
+    def split_batch(self, max_latent_batch_size: int) -> List[int]:
+        # sizes of the latent batches the requested images are generated in
+        full_batches, rest = divmod(self.batch_size, max_latent_batch_size)
+        return [max_latent_batch_size] * full_batches + ([rest] if rest else [])
+
+    def split_jobs(self, latent_batch_sizes: List[int]) -> List['GenerationParameters']:
+        # parameters of each job of the request, every job gets its own seed (consecutive seeds from a seed set by the user)
+        return [
+            replace(self, latent_batch_size=latent_batch_size,
+                    seed=self.seed + i if self.is_set_seed else random.randint(0, 2**32 - 1))
+            for i, latent_batch_size in enumerate(latent_batch_sizes)
+        ]
+
     def create_description(self):
         desc = f"Size: {self.width}x{self.height}\nSeed: `{self.seed}`\nGuidance: {self.cfg}\nSteps: {self.steps}"
+        if self.latent_batch_size > 1:
+            # a single seed is used for the whole latent batch, an image is identified by its position in it
+            desc += f"\nLatent batch: {self.latent_batch_size} images"
         if self.lora:
             desc += f"\nLora: `{self.lora}`\nLora strength: {self.lora_strength}"
         if self.mode != "default":
@@ -203,143 +174,332 @@ class GenerationParameters:
         return desc
 
 
+@dataclass
+class SubmittedGeneration:
+    prompt_id: str
+    workflow: dict # nodes of the submitted workflow, used for node titles and output nodes
+    messages: asyncio.Queue
+    backend: ComfyUIBackend
+    cancelled: bool = False
+    submitted: float = field(default_factory=time.monotonic)
+    received_images: List[bytes] = field(default_factory=list) # final images sent over the websocket
+
+
 class ComfyUIImageGeneration:
-    def __init__(self, config: ImageGenerationConfig):
+    def __init__(self, config: ImageGenerationConfig, client_id: Optional[str] = None, on_running: Callable[[Job], None] = lambda task: None):
         self.config = config
+        self.on_running = on_running
+        if config.output_mode not in ("history", "websocket"):
+            raise ValueError(f"Invalid output mode '{config.output_mode}'")
         with open(self.config.workflow_filepath, "r") as file:
             self.workflow = json.load(file)
+        # the workflow is compiled once for generations with and without a LoRA
+        self.workflow_templates: Dict[bool, WorkflowTemplate] = {False: compile_workflow(self.workflow, config, lora=False)}
+        if config.workflow.lora_node is not None:
+            self.workflow_templates[True] = compile_workflow(self.workflow, config, lora=True)
+        self.backends = ComfyUIBackendPool(self.config, client_id)
+        # the font file is read once, fonts are created for each size that is needed
+        try:
+            self._font_data: Optional[bytes] = Path(self.config.placeholder_image_font_filepath).read_bytes()
+        except OSError:
+            logger.warning(f"Failed to load the placeholder font {self.config.placeholder_image_font_filepath}, using the default font")
+            self._font_data = None
+        self._fonts: Dict[int, ImageFont.FreeTypeFont] = {}
+        self._placeholders: OrderedDict[Tuple[int, int], Union[bytes, str]] = OrderedDict()
+        self.previews = PreviewEncoder(self.config.previews)
+        self.results = ResultCache(self.config.result_cache) if self.config.result_cache.enabled else None
+        self.runtimes = RuntimeEstimator(self.config.runtime_estimate)
+        # results of a different workflow (or different models) are not reused
+        self._result_key_base = {
+            "workflow": hashlib.sha256(json.dumps(self.workflow, sort_keys=True).encode()).hexdigest(),
+            "model": config.model, "vae": config.vae, "clip_t5": config.clip_t5, "clip_l": config.clip_l,
+        }
+
+    async def close(self):
+        await self.backends.close()
+        self.previews.close()
+
+    def placeholder_image(self, gp: GenerationParameters) -> Union[bytes, str]:
+        # rendered once per size, after the first upload the Telegram file_id is returned instead of the image
+        key = (gp.width, gp.height)
+        placeholder = self._placeholders.get(key)
+        if placeholder is None:
+            placeholder = self.create_placeholder_image(gp)
+            self._placeholders[key] = placeholder
+            if len(self._placeholders) > PLACEHOLDER_CACHE_SIZE:
+                self._placeholders.popitem(last=False)
+        else:
+            self._placeholders.move_to_end(key)
+        return placeholder
+
+    def set_placeholder_file_id(self, gp: GenerationParameters, file_id: Optional[str]) -> None:
+        # None forgets the file_id (e.g. when Telegram does not accept it anymore), the image is rendered again
+        key = (gp.width, gp.height)
+        if file_id is None:
+            self._placeholders.pop(key, None)
+        else:
+            self._placeholders[key] = file_id
 
-    def create_placeholder_image(self, gp: GenerationParameters):
+    def create_placeholder_image(self, gp: GenerationParameters) -> bytes:
         width, height = gp.width, gp.height
         placeholder_image = Image.new('RGB', (width, height), color='black')
         draw = ImageDraw.Draw(placeholder_image)
         text = f"{width}x{height}"
-        try:
-            font = ImageFont.truetype(str(self.config.placeholder_image_font_filepath), width//10)
-        except IOError:
-            font = ImageFont.load_default(width//10)
+        font = self._placeholder_font(width//10)
         text_left, text_top, text_right, text_bottom = draw.textbbox((width // 2, height // 2), text, font=font, anchor="mm")
         draw.text((text_left, text_top), text, font=font, fill='white')
-        placeholder_path = f"placeholder_{gp.user_id}.jpg"
-        placeholder_image.save(placeholder_path)
-        return placeholder_path
-
-    def _prepare_workflow(self, gp: GenerationParameters) -> dict:
-        workflow = deepcopy(self.workflow)
-        if gp.lora is None:
-            workflow.pop("55")
-            workflow["22"]["inputs"]["model"][0] = "54" # disable lora (reroute node)
-        else:
-            workflow["55"]["inputs"]["lora_name"] = gp.lora
-            workflow["55"]["inputs"]["strength_model"] = gp.lora_strength
-
-        if self.config.save_images:
-            workflow.pop("59")
+        placeholder = io.BytesIO()
+        placeholder_image.save(placeholder, "JPEG")
+        return placeholder.getvalue()
+
+    def _placeholder_font(self, size: int) -> ImageFont.FreeTypeFont:
+        font = self._fonts.get(size)
+        if font is None:
+            try:
+                font = ImageFont.truetype(io.BytesIO(self._font_data), size) if self._font_data is not None else ImageFont.load_default(size)
+            except IOError:
+                font = ImageFont.load_default(size)
+            self._fonts[size] = font
+        return font
+
+    def _result_key(self, gp: GenerationParameters) -> Optional[str]:
+        # only generations with a seed set by the user are deterministic
+        if self.results is None or not gp.is_set_seed:
+            return None
+        values = {**self._result_key_base, **self._workflow_values(gp)}
+        return hashlib.sha256(json.dumps(values, sort_keys=True).encode()).hexdigest()
+
+    def has_cached_result(self, gp: GenerationParameters) -> bool:
+        key = self._result_key(gp)
+        return key is not None and key in self.results
+
+    def cached_result(self, gp: GenerationParameters) -> Optional[List[CachedImage]]:
+        key = self._result_key(gp)
+        return self.results.get(key) if key is not None else None
+
+    def set_result_file_ids(self, gp: GenerationParameters, file_ids: Optional[List[str]]) -> None:
+        # None forgets the result (e.g. when Telegram does not accept the file_ids anymore)
+        key = self._result_key(gp)
+        if key is None:
+            return
+        if file_ids is None:
+            self.results.forget(key)
         else:
-            workflow.pop("52")
+            self.results.put(key, file_ids)
 
-        workflow["54"]["inputs"]["unet_name"] = self.config.model
-        workflow["10"]["inputs"]["vae_name"] = self.config.vae
-        workflow["11"]["inputs"]["clip_name1"] = self.config.clip_t5
-        workflow["11"]["inputs"]["clip_name2"] = self.config.clip_l
+    @staticmethod
+    def final_caption(gp: GenerationParameters, image_count: int) -> str:
+        return f"Final {'image' if image_count == 1 else 'images'} generated with settings:\n{gp.create_description().replace('.', '\\.')}"
 
-        workflow["6"]["inputs"]["text"] = gp.prompt
+    def _workflow_template(self, gp: GenerationParameters) -> WorkflowTemplate:
+        template = self.workflow_templates.get(gp.lora is not None)
+        if template is None:
+            raise Exception("The workflow does not support LoRAs")
+        return template
 
-        workflow["25"]["inputs"]["noise_seed"] = gp.seed
+    @staticmethod
+    def _workflow_values(gp: GenerationParameters) -> Dict[str, Any]:
+        return {
+            "prompt": gp.prompt,
+            "seed": gp.seed,
+            "width": gp.width,
+            "height": gp.height,
+            "batch_size": gp.latent_batch_size,
+            "cfg": gp.cfg,
+            "sampler": gp.sampler,
+            "scheduler": gp.scheduler,
+            "steps": gp.steps,
+            "lora": gp.lora,
+            "lora_strength": gp.lora_strength,
+        }
 
-        workflow["27"]["inputs"]["width"] = gp.width
-        workflow["27"]["inputs"]["height"] = gp.height
+    async def start(self):
+        self.backends.start()
 
-        workflow["26"]["inputs"]["guidance"] = gp.cfg
-        workflow["16"]["inputs"]["sampler_name"] = gp.sampler
-        workflow["17"]["inputs"]["scheduler"] = gp.scheduler
-        workflow["17"]["inputs"]["steps"] = gp.steps
-        return workflow
-    
-    async def generate_image(self, gp: GenerationParameters, edit_caption_callback, edit_media_callback, user_queues):
-        logger.info(f"Generation started for user {gp.user_id}")
+    async def submit(self, gp: GenerationParameters) -> SubmittedGeneration:
         gp.update_before_generation()
-        workflow = self._prepare_workflow(gp)
-        
-        comfy_prompt = {
-            "prompt": workflow,
-            "client_id": str(gp.user_id)
-        }
+        # the serialized workflow is sent as is, the template describes its nodes
+        template = self._workflow_template(gp)
+        workflow = template.render(self._workflow_values(gp))
+
+        backend, prompt_id = await self.backends.submit(workflow, gp.lora_key())
+        logger.info(f"Queued prompt {prompt_id} on {backend.name} for user {gp.user_id}")
+        return SubmittedGeneration(prompt_id, template.nodes, backend.websocket.subscribe(prompt_id), backend)
+
+    async def reattach(self, prompt_id: str, backend_name: str, workflow: dict) -> Tuple[Optional[SubmittedGeneration], bool]:
+        # follows a prompt submitted before a restart if ComfyUI still has it, returns whether it is running
+        backend = self.backends.get(backend_name)
+        if backend is None:
+            return None, False
+        messages = backend.websocket.subscribe(prompt_id)
+        try:
+            history = await backend.client.get_history(prompt_id)
+            running = False
+            if prompt_id not in history:
+                queue = await backend.client.get_queue()
+                running = any(item[1] == prompt_id for item in queue.get("queue_running", []))
+                if not running and not any(item[1] == prompt_id for item in queue.get("queue_pending", [])):
+                    backend.websocket.unsubscribe(prompt_id, messages)
+                    return None, False
+        except Exception:
+            backend.websocket.unsubscribe(prompt_id, messages)
+            raise
+        # the messages sent while the bot was not running are lost, the prompt state is checked again when the generation is followed
+        messages.put_nowait({"type": "reconnected", "data": {"prompt_id": prompt_id}})
+        logger.info(f"Reattached to prompt {prompt_id} on {backend.name}")
+        return SubmittedGeneration(prompt_id, workflow, messages, backend), running
+
+    async def cancel(self, submission: SubmittedGeneration):
+        await self.cancel_many([submission])
+
+    async def cancel_many(self, submissions: List[SubmittedGeneration]):
+        # the prompts are removed from ComfyUI right away, without waiting for websocket messages,
+        # a generation that was already cancelled is skipped
+        by_backend: Dict[ComfyUIBackend, List[SubmittedGeneration]] = {}
+        for submission in submissions:
+            if not submission.cancelled:
+                by_backend.setdefault(submission.backend, []).append(submission)
+        results = await asyncio.gather(
+            *(self._cancel_prompts(backend, [submission.prompt_id for submission in backend_submissions])
+              for backend, backend_submissions in by_backend.items()),
+            return_exceptions=True)
+        # generations whose prompts ComfyUI did not remove keep following them, the generation loop tries again
+        errors = []
+        for backend_submissions, result in zip(by_backend.values(), results):
+            if isinstance(result, Exception):
+                errors.append(result)
+                continue
+            for submission in backend_submissions:
+                submission.cancelled = True
+                submission.backend.websocket.unsubscribe(submission.prompt_id, submission.messages)
+        if errors:
+            raise errors[0]
 
-        async with websockets.connect(f"{self.config.websocket_url}?clientId={gp.user_id}") as websocket:
-            response = requests.post(f"{self.config.server_url}/prompt", json=comfy_prompt)
-            prompt_id = response.json()['prompt_id']
-            websocket_task = asyncio.create_task(self._process_websocket_messages(gp.user_id, workflow, websocket, user_queues, prompt_id, edit_caption_callback, edit_media_callback))
-            ok = await websocket_task
+    @staticmethod
+    async def _cancel_prompts(backend: ComfyUIBackend, prompt_ids: List[str]):
+        # the queue tells which prompt is running, the others are removed from the queue with one request
+        queue = await backend.client.get_queue()
+        running = {item[1] for item in queue.get("queue_running", [])}
+        queued = [prompt_id for prompt_id in prompt_ids if prompt_id not in running]
+        if queued:
+            await backend.client.delete_queued(queued)
+        for prompt_id in prompt_ids:
+            if prompt_id in running:
+                await backend.client.interrupt(prompt_id)
+        logger.info(f"Cancelled {len(prompt_ids)} prompt(s) on {backend.name}")
+
+    def wake(self, submission: SubmittedGeneration):
+        # makes the generation check its task state without waiting for the next websocket message
+        submission.messages.put_nowait({"type": "wake", "data": {"prompt_id": submission.prompt_id}})
+
+    async def generate_image(self, gp: GenerationParameters, submission: SubmittedGeneration, task: Job, status: StatusUpdater, send_media_group_callback) -> str:
+        # returns the final state of the job ("done", "failed" or "cancelled")
+        logger.info(f"Generation started for user {gp.user_id}")
+        prompt_id = submission.prompt_id
+        try:
+            ok = await self._process_websocket_messages(submission, task, status)
+        finally:
+            submission.backend.websocket.unsubscribe(prompt_id, submission.messages)
         if not ok:
-            return
+            return 'cancelled' if task.cancel else 'failed'
         
         logger.info("Generation complete")
-        await edit_caption_callback("Image generation complete. Fetching final result...")
-
-        history_response = requests.get(f"{self.config.server_url}/history/{prompt_id}")
-        history = history_response.json()
-
-        output_data = history[prompt_id]['outputs']
-        image_filename = None
+        with metrics.span("fetch", task.timings):
+            if submission.received_images:
+                images = [self._prepare_for_telegram(image_bytes) for image_bytes in submission.received_images]
+                # the job only keeps its images until they are sent
+                submission.received_images.clear()
+            else:
+                status.update_caption("Image generation complete. Fetching final result...")
+                images = await self._fetch_output_images(submission)
+
+        if images:
+            key = self._result_key(gp)
+            if key is not None:
+                self.results.put(key, images)
+            final_caption = self.final_caption(gp, len(images))
+            with metrics.span("upload", task.timings):
+                if len(images) == 1:
+                    logger.debug("Sending final image")
+                    await status.edit_media(caption=final_caption, media=images[0], parse_mode='MarkdownV2')
+                else:
+                    logger.debug(f"Sending {len(images)} final images")
+                    await status.close()
+                    await send_media_group_callback(caption=final_caption, media=images, parse_mode='MarkdownV2')
+            return 'done'
+        logger.error("Failed to find result image")
+        await status.edit_caption("Failed to generate image.")
+        return 'failed'
+
+    async def _fetch_output_images(self, submission: SubmittedGeneration) -> List[bytes]:
+        history = await submission.backend.client.get_history(submission.prompt_id)
+
+        output_data = history[submission.prompt_id]['outputs']
+        output_images = []
         for node_id, node_output in output_data.items():
             if 'images' in node_output:
-                image_filename = node_output['images'][0]['filename']
+                output_images = node_output['images']
                 break
 
-        if image_filename:
-            image_url = f"{self.config.server_url}/view?filename={image_filename}"
-            if not self.config.save_images:
-                image_url += "&type=temp"
-            image_response = requests.get(image_url)
-            image = Image.open(io.BytesIO(image_response.content))
-            temp_image_path = f"temp_image_{gp.user_id}.png"
-            image.save(temp_image_path)
-            final_caption = f"Final image generated with settings:\n{gp.create_description().replace('.', '\\.')}"
-            logger.debug("Sending final image")
-            await edit_media_callback(caption=final_caption, media_path=temp_image_path, parse_mode='MarkdownV2')
-            os.remove(temp_image_path)
-        else:
-            logger.error("Failed to find result image")
-            await edit_caption_callback("Failed to generate image.")
+        images = []
+        for output_image in output_images:
+            image_bytes = await submission.backend.client.get_image(output_image['filename'], output_image.get('subfolder', ''), output_image.get('type', 'output'))
+            images.append(self._prepare_for_telegram(image_bytes))
+        return images
 
-    async def _process_websocket_messages(self, user_id, workflow, websocket, user_queues, prompt_id, edit_caption_callback, edit_media_callback):
+    @staticmethod
+    def _prepare_for_telegram(image_bytes: bytes) -> bytes:
+        # the image is sent as is unless it is too large for a Telegram photo
+        if len(image_bytes) <= TELEGRAM_PHOTO_MAX_BYTES:
+            return image_bytes
+        image = Image.open(io.BytesIO(image_bytes))
+        output = io.BytesIO()
+        image.convert("RGB").save(output, "JPEG", quality=95)
+        return output.getvalue()
+
+    async def _process_websocket_messages(self, submission: SubmittedGeneration, task: Job, status: StatusUpdater):
         logger.debug("Start websocket communication")
+        prompt_id = submission.prompt_id
+        workflow = submission.workflow
         show_preview = False
         current_caption = None
-
-        async for message in websocket:
-            if user_queues[user_id][0]['cancel']:
-                logger.info("Generation cancelled")
-                if user_queues[user_id][0]["running"]:
-                    response = requests.post(f"{self.config.server_url}/interrupt")
-                    logger.debug("ws Response:", response.text)
+        current_node = None
+        preview_step = None
+        websocket_output_node_ids = {node_id for node_id, node in workflow.items() if node["class_type"] == "SaveImageWebsocket"}
+
+        while True:
+            message = await submission.messages.get()
+            if isinstance(message, dict) and message['type'] in ('execution_start', 'executing') and not task.running:
+                task.running = True
+                task.started = time.monotonic()
+                metrics.record("comfyui_queue", task.started - submission.submitted, task.timings)
+                self.on_running(task)
+            if task.cancel:
+                try:
+                    await self.cancel(submission)
+                except Exception as e:
+                    # the prompt is still in ComfyUI, cancelling it is tried again with the next message
+                    logger.error(f"Failed to cancel prompt {prompt_id}: {e!r}")
                 else:
-                    response = requests.post(f"{self.config.server_url}/queue", json={"delete": [prompt_id]})
-                    logger.debug("ws Response:", response.text)
-                await edit_caption_callback("Image generation cancelled.")
-                return False
+                    logger.info("Generation cancelled")
+                    await status.edit_caption("Image generation cancelled.")
+                    return False
 
-            if isinstance(message, str):
-                logger.debug(f"ws Message: {message}")
+            if isinstance(message, dict):
                 show_preview = False
-                data = json.loads(message)
-                if 'data' in data and data['data'].get('prompt_id') != prompt_id:
-                    continue
-                elif data['type'] == 'executing':
-                    user_queues[user_id][0]["running"] = True
+                data = message
+                if data['type'] == 'executing':
                     node_id = data['data']['node']
-                    if node_id:
-                        node_title = workflow[node_id]["_meta"]["title"]
-                    else:
-                        node_title = ""
-
+                    current_node = node_id
+                    node_title = workflow[node_id]["_meta"]["title"] if node_id else ""
                     current_caption = f"Executing node {node_title}..."
                 elif data['type'] == 'progress':
                     value = data['data']['value']
                     max_value = data['data']['max']
-                    if (value-1) % self.config.update_preview_every_n_steps == 0:
+                    # previews are shown less often when Telegram edits are slow or many generations are running
+                    if (preview_step is None or value - preview_step >= self.config.update_preview_every_n_steps) and status.preview_due():
                         show_preview = True
+                        preview_step = value
                     logger.info(f"Generation progress {value}/{max_value}")
                     current_caption = f"Progress: {value}/{max_value}"
                 elif data['type'] == 'executed':
@@ -348,23 +508,41 @@ class ComfyUIImageGeneration:
                 elif data['type'] == 'execution_cached':
                     current_caption = "Using cached execution..."
                 elif data['type'] == 'execution_success':
+                    if task.started is not None:
+                        metrics.record("execution", time.monotonic() - task.started, task.timings)
+                        self.runtimes.observe(task.params, time.monotonic() - task.started)
                     break
                 elif data['type'] == 'execution_error':
                     logger.info(f"Generation failed {data['data']}")
                     caption = "Failed to generate image, an error has occured. Try again."
                     if "data" in data:
                         caption += f" (Error type: {data['data'].get('exception_type')}, Error message: {data['data'].get('exception_message')})"
-                    await edit_caption_callback(caption)
+                    await status.edit_caption(caption)
+                    return False
+                elif data['type'] == 'execution_interrupted':
+                    logger.info("Generation interrupted")
+                    await status.edit_caption("Image generation was interrupted.")
+                    return False
+                elif data['type'] == 'reconnected':
+                    # the websocket was down for a while, the prompt might have finished in the meantime
+                    history = await submission.backend.client.get_history(prompt_id)
+                    if prompt_id not in history:
+                        continue
+                    if history[prompt_id].get('status', {}).get('status_str') == 'success':
+                        break
+                    logger.info("Generation failed while the websocket was disconnected")
+                    await status.edit_caption("Failed to generate image, an error has occured. Try again.")
+                    return False
                 else:
                     continue
-                await edit_caption_callback(current_caption)
+                status.update_caption(current_caption)
+
+            elif current_node in websocket_output_node_ids:
+                logger.debug("Received final image over websocket")
+                submission.received_images.append(parse_preview_frame(message)[1])
 
             elif show_preview:
                 logger.debug(f"Updating preview")
-                image = Image.open(io.BytesIO(message[8:]))
-                temp_preview_path = f"temp_preview_{user_id}.png"
-                image.save(temp_preview_path, "PNG")
-                await edit_media_callback(caption=current_caption, media_path=temp_preview_path)
-                os.remove(temp_preview_path)
+                status.update_preview(current_caption, await self.previews.encode(message))
         return True
 
@@ -0,0 +1,121 @@
+import asyncio
+from dataclasses import dataclass, field
+import json
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+import uuid
+
+if TYPE_CHECKING:
+    from .image_gen import GenerationParameters, SubmittedGeneration
+
+# states of jobs that are still in progress, they are resumed after a restart
+UNFINISHED_STATES = ("pending", "enhancing", "submitted", "running")
+JSON_COLUMNS = ("params", "submitted_params", "workflow")
+
+
+@dataclass(slots=True, eq=False)
+class Job:
+    # one queued generation, Telegram objects are not kept, messages are addressed by chat and message id
+    job_id: int
+    chat_id: int
+    message_id: int
+    params: 'GenerationParameters' # parameters of this job only (its own seed and latent batch size)
+    cancel: bool = False
+    running: bool = False
+    submitting: bool = False # the placeholder is being sent and the workflow submitted, the job is not interrupted anymore
+    submitted: bool = False # the job was submitted to ComfyUI (or failed)
+    submission: Optional['SubmittedGeneration'] = None
+    status_message_id: Optional[int] = None
+    enhanced_prompt: Optional[asyncio.Future] = None
+    handle: Optional[asyncio.Task] = None # set by the scheduler when the job is started
+    skipped: int = 0 # how many times the scheduler started a job with a preferred LoRA first
+    queued: float = field(default_factory=time.monotonic)
+    started: Optional[float] = None # when ComfyUI started to execute the job (monotonic time)
+    timings: Dict[str, float] = field(default_factory=dict) # seconds spent in each stage, logged when the job is finished
+    # an asyncio.Event takes more memory than the rest of the job, it is only created when the next job of the user waits
+    _submitted_event: Optional[asyncio.Event] = field(default=None, init=False, repr=False)
+
+    @property
+    def user_id(self) -> int:
+        return self.params.user_id
+
+    def set_submitted(self) -> None:
+        self.submitted = True
+        if self._submitted_event is not None:
+            self._submitted_event.set()
+
+    async def wait_submitted(self) -> None:
+        if self.submitted:
+            return
+        if self._submitted_event is None:
+            self._submitted_event = asyncio.Event()
+        await self._submitted_event.wait()
+
+
+class JobStore:
+    # generation jobs are stored in SQLite (write-ahead log) so that they survive restarts of the bot
+    def __init__(self, filepath: str):
+        self._db = sqlite3.connect(filepath, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                params TEXT NOT NULL, -- as requested, before the prompt templates and the enhancement are applied
+                submitted_params TEXT, -- as submitted to ComfyUI (final prompt and seed)
+                state TEXT NOT NULL,
+                enhanced_prompt TEXT,
+                status_message_id INTEGER,
+                prompt_id TEXT,
+                backend TEXT,
+                workflow TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def client_id(self) -> str:
+        # the ComfyUI client id stays the same across restarts, ComfyUI sends the progress of a prompt only to the client that queued it
+        row = self._db.execute("SELECT value FROM settings WHERE key = 'client_id'").fetchone()
+        if row is not None:
+            return row["value"]
+        client_id = uuid.uuid4().hex
+        self._db.execute("INSERT INTO settings (key, value) VALUES ('client_id', ?)", (client_id,))
+        return client_id
+
+    def add(self, user_id: int, chat_id: int, message_id: int, params: dict) -> int:
+        now = time.time()
+        cursor = self._db.execute(
+            "INSERT INTO jobs (user_id, chat_id, message_id, params, state, created, updated) VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+            (user_id, chat_id, message_id, json.dumps(params), now, now))
+        return cursor.lastrowid
+
+    def update(self, job_id: int, **fields: Any) -> None:
+        fields = {name: json.dumps(value) if name in JSON_COLUMNS and value is not None else value for name, value in fields.items()}
+        fields["updated"] = time.time()
+        self._db.execute(f"UPDATE jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?", (*fields.values(), job_id))
+
+    def finish(self, job_id: int) -> None:
+        # only unfinished jobs are needed after a restart, the row with the workflow and the parameters is removed
+        self._db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def unfinished(self) -> List[dict]:
+        rows = self._db.execute(
+            f"SELECT * FROM jobs WHERE state IN ({', '.join('?' * len(UNFINISHED_STATES))}) ORDER BY id", UNFINISHED_STATES).fetchall()
+        jobs = []
+        for row in rows:
+            job = dict(row)
+            for name in JSON_COLUMNS:
+                if job[name] is not None:
+                    job[name] = json.loads(job[name])
+            jobs.append(job)
+        return jobs
+
+    def close(self) -> None:
+        self._db.close()
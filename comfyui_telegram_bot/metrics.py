@@ -0,0 +1,160 @@
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from .config import MetricsConfig
+from . import logger
+
+# seconds, from status message edits to long generations
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# time between a job being queued and its final image being sent, split into stages
+STAGES = ("parse", "queue", "enhance", "placeholder", "submit", "comfyui_queue", "execution", "fetch", "upload")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra is not None else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(labels)} {value:g}" for labels, value in self._values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {} # labels -> (count per bucket, [sum])
+
+    def observe(self, value: float, **labels: str) -> None:
+        counts, total = self._values.setdefault(_labels(labels), ([0] * (len(self.buckets) + 1), [0.0]))
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                bound = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f"{self.name}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total[0]:g}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    # a value that is kept elsewhere (e.g. the hit counter of a cache), it is read when the metrics are rendered
+    def __init__(self, name: str, help: str, kind: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}", f"{self.name} {self.read():g}"]
+
+
+class Metrics:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+        self.stage_seconds = self.histogram("bot_stage_seconds", "Duration of the stages of a job")
+        self.jobs = self.counter("bot_jobs_total", "Finished jobs by final state (done, cached, failed, cancelled)")
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help, buckets))
+
+    def callback(self, name: str, help: str, read: Callable[[], float], kind: str = "gauge") -> None:
+        self._metrics[name] = CallbackMetric(name, help, kind, read)
+
+    def record(self, stage: str, seconds: float, timings: Optional[Dict[str, float]] = None) -> None:
+        # timings collects the stages of one job for its summary in the debug log
+        self.stage_seconds.observe(seconds, stage=stage)
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage: str, timings: Optional[Dict[str, float]] = None) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, timings)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+def format_timings(timings: Dict[str, float]) -> str:
+    stages = sorted(timings, key=lambda stage: STAGES.index(stage) if stage in STAGES else len(STAGES))
+    return ", ".join(f"{stage} {timings[stage]:.2f}s" for stage in stages)
+
+
+class MetricsServer:
+    # minimal HTTP server for Prometheus, every request is answered with the current metrics
+    def __init__(self, config: MetricsConfig, metrics: 'Metrics'):
+        self.config = config
+        self.metrics = metrics
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.config.host, self.config.port)
+        logger.info(f"Serving metrics on http://{self.config.host}:{self.config.port}/metrics")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.metrics.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+# shared by all modules, like the logger
+metrics = Metrics()
@@ -0,0 +1,81 @@
+from dataclasses import dataclass, field
+import re
+from typing import Any, Dict, Iterable, List, Optional
+
+
+class ParameterError(ValueError):
+    def __init__(self, message: str, position: Optional[int] = None):
+        super().__init__(f"{message} (at character {position + 1})" if position is not None else message)
+        self.position = position
+
+
+# all parameters in one pattern, at the same position the earlier alternatives take precedence,
+# known parameter names with a value that is not valid are matched by the last alternative
+PARAMETER_PATTERN = re.compile(r"""
+    \b(?:
+        (?:
+            (?P<size_width>\d+)x(?P<size_height>\d+)
+          | (?P<ratio_width>\d+\.?\d*):(?P<ratio_height>\d+\.?\d*)
+          | (?P<mp_count>\d+\.?\d*)MP
+          | (?P<batch_size>\d+)x
+          | s=(?P<steps>\d+)
+          | cfg=(?P<cfg>\d+\.?\d*)
+          | m=(?P<mode>[a-zA-Z]+)
+          | seed=(?P<seed>\d+)
+          | pe=(?P<prompt_enhance>\w+)
+        )\b
+      | (?P<invalid>(?:s|cfg|m|seed|pe)=\S*)
+    )
+""", re.VERBOSE)
+
+# last matched group -> (parameter name, value)
+PARAMETER_VALUES = {
+    "size_height": lambda match: ("size", (int(match["size_width"]), int(match["size_height"]))),
+    "ratio_height": lambda match: ("ratio", (float(match["ratio_width"]), float(match["ratio_height"]))),
+    "mp_count": lambda match: ("mp_count", float(match["mp_count"])),
+    "batch_size": lambda match: ("batch_size", int(match["batch_size"])),
+    "steps": lambda match: ("steps", int(match["steps"])),
+    "cfg": lambda match: ("cfg", float(match["cfg"])),
+    "mode": lambda match: ("mode", match["mode"]),
+    "seed": lambda match: ("seed", int(match["seed"])),
+    "prompt_enhance": lambda match: ("prompt_enhance", match["prompt_enhance"]),
+}
+
+
+@dataclass
+class ParsedMessage:
+    prompt: str
+    params: Dict[str, Any] = field(default_factory=dict)
+    positions: Dict[str, int] = field(default_factory=dict) # parameter name -> position of its value in the message
+
+
+def parse_message(message: str) -> ParsedMessage:
+    # the message is scanned once, the parameters are cut out of it and the rest is the prompt
+    params = {}
+    positions = {}
+    prompt_parts = []
+    end = 0
+    for match in PARAMETER_PATTERN.finditer(message):
+        group = match.lastgroup
+        if group == "invalid":
+            raise ParameterError(f"Invalid parameter '{match.group()}'", match.start())
+        name, value = PARAMETER_VALUES[group](match)
+        _validate(name, value, match.start())
+        # the last occurrence of a parameter wins
+        params[name] = value
+        positions[name] = match.start()
+        prompt_parts.append(message[end:match.start()])
+        end = match.end()
+    prompt_parts.append(message[end:])
+    return ParsedMessage("".join(prompt_parts).strip(), params, positions)
+
+
+def parse_messages(messages: Iterable[str]) -> List[ParsedMessage]:
+    return [parse_message(message) for message in messages]
+
+
+def _validate(name: str, value: Any, position: int) -> None:
+    if name in ("size", "ratio") and min(value) <= 0:
+        raise ParameterError(f"Invalid {name} {value[0]:g}{'x' if name == 'size' else ':'}{value[1]:g}", position)
+    if name in ("mp_count", "batch_size", "steps") and value <= 0:
+        raise ParameterError(f"Invalid {name.replace('_', ' ')} {value:g}", position)
@@ -0,0 +1,53 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import math
+import struct
+from typing import Optional, Tuple
+
+from PIL import Image
+
+from .config import PreviewConfig
+from . import logger
+
+# binary websocket messages start with the event type and the image type (big endian 32 bit integers)
+FRAME_HEADER = struct.Struct(">II")
+IMAGE_TYPES = {1: "JPEG", 2: "PNG"}
+
+
+def parse_preview_frame(message: bytes) -> Tuple[Optional[str], bytes]:
+    _, image_type = FRAME_HEADER.unpack_from(message)
+    return IMAGE_TYPES.get(image_type), message[FRAME_HEADER.size:]
+
+
+class PreviewEncoder:
+    # previews are only shown for a few seconds, they are downscaled and compressed to stay within a size budget
+    def __init__(self, config: PreviewConfig):
+        self.config = config
+        self._executor = ThreadPoolExecutor(max_workers=config.workers, thread_name_prefix="preview")
+
+    async def encode(self, message: bytes) -> bytes:
+        image_format, image_bytes = parse_preview_frame(message)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, image_format, image_bytes)
+
+    def _encode(self, image_format: Optional[str], image_bytes: bytes) -> bytes:
+        image = Image.open(io.BytesIO(image_bytes), formats=[image_format] if image_format else None)
+        pixels = image.width * image.height
+        if len(image_bytes) <= self.config.max_bytes and pixels <= self.config.max_pixels:
+            return image_bytes
+        if pixels > self.config.max_pixels:
+            scale = math.sqrt(self.config.max_pixels / pixels)
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))), Image.Resampling.BILINEAR)
+        image = image.convert("RGB")
+        quality = self.config.jpeg_quality
+        while True:
+            output = io.BytesIO()
+            image.save(output, "JPEG", quality=quality)
+            if output.tell() <= self.config.max_bytes or quality <= self.config.min_jpeg_quality:
+                break
+            quality = max(self.config.min_jpeg_quality, quality - 15)
+        logger.debug(f"Encoded preview {len(image_bytes)} -> {output.tell()} bytes ({image.width}x{image.height}, quality {quality})")
+        return output.getvalue()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
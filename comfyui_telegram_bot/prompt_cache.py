@@ -0,0 +1,121 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, Optional
+
+from .config import PromptCacheConfig, PromptEnhanceConfig
+from .prompt_enhance import PromptEnhanceService
+from . import logger
+
+
+class PromptCache:
+    # recently used prompts are kept in memory, all of them in a size capped SQLite database that survives restarts
+    def __init__(self, config: PromptCacheConfig):
+        self.config = config
+        self._memory: OrderedDict[str, str] = OrderedDict()
+        self._db: Optional[sqlite3.Connection] = None
+        if config.filepath:
+            self._db = sqlite3.connect(config.filepath, check_same_thread=False, isolation_level=None)
+            self._db.execute("CREATE TABLE IF NOT EXISTS prompts (key TEXT PRIMARY KEY, prompt TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS prompts_last_used ON prompts (last_used)")
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def get(self, key: str) -> Optional[str]:
+        prompt = self._memory.get(key)
+        if prompt is not None:
+            self._memory.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute("SELECT prompt FROM prompts WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                prompt = row[0]
+                self._db.execute("UPDATE prompts SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._remember(key, prompt)
+        if prompt is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return prompt
+
+    def put(self, key: str, prompt: str) -> None:
+        self._remember(key, prompt)
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO prompts (key, prompt, last_used) VALUES (?, ?, ?)", (key, prompt, time.time()))
+            self._db.execute("DELETE FROM prompts WHERE key IN (SELECT key FROM prompts ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                             (self.config.max_disk_entries,))
+
+    def _remember(self, key: str, prompt: str) -> None:
+        self._memory[key] = prompt
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.config.memory_entries:
+            self._memory.popitem(last=False)
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class CachedPromptEnhanceService(PromptEnhanceService):
+    # sits in front of a prompt enhancement service, identical requests that are in flight at the same time
+    # (e.g. all images of a batch) are sent to the LLM only once
+    def __init__(self, service: PromptEnhanceService, service_name: str, config: PromptEnhanceConfig):
+        super().__init__(config)
+        self.service = service
+        self.service_name = service_name
+        self.cache = PromptCache(config.cache)
+        self._in_flight: Dict[str, asyncio.Task] = {}
+
+    def _key(self, user_prompt: str, pe_type: str) -> Optional[str]:
+        type_config = self.config.types.get(pe_type)
+        if type_config is None:
+            return None
+        system_prompt_hash = hashlib.sha256(type_config.system_prompt.encode()).hexdigest()
+        key = json.dumps([self.service_name, self.config.model, pe_type, system_prompt_hash, user_prompt])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def enhance_prompt(self, user_prompt: str, pe_type: str) -> Optional[str]:
+        key = self._key(user_prompt, pe_type)
+        prompt = self.cache.get(key) if key is not None else None
+        if prompt is None:
+            prompt = self.service.enhance_prompt(user_prompt, pe_type)
+            if key is not None and prompt is not None:
+                self.cache.put(key, prompt)
+        return prompt
+
+    async def enhance_prompt_async(self, user_prompt: str, pe_type: str) -> Optional[str]:
+        key = self._key(user_prompt, pe_type)
+        if key is None:
+            return await self.service.enhance_prompt_async(user_prompt, pe_type)
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.cache.hits += 1
+        else:
+            prompt = self.cache.get(key)
+            if prompt is not None:
+                logger.debug(f"Prompt cache hit, hit rate: {self.cache.hit_rate:.0%} ({self.cache.hits} hits, {self.cache.misses} misses)")
+                return prompt
+            # the request is not cancelled together with the task that started it, other tasks may be waiting for it
+            in_flight = asyncio.create_task(self.service.enhance_prompt_async(user_prompt, pe_type))
+            in_flight.add_done_callback(lambda task: self._on_enhanced(key, task))
+            self._in_flight[key] = in_flight
+        return await asyncio.shield(in_flight)
+
+    def _on_enhanced(self, key: str, task: asyncio.Task) -> None:
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            self.cache.put(key, task.result())
+
+    async def close(self) -> None:
+        for task in self._in_flight.values():
+            task.cancel()
+        await self.service.close()
+        self.cache.close()
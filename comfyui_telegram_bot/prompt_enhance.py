@@ -1,6 +1,8 @@
+import asyncio
 from importlib import import_module
 import inspect
 import os
+import random
 from typing import Type, Dict, Any, Optional
 
 from .config import PromptEnhanceConfig
@@ -8,10 +10,26 @@ from .config import PromptEnhanceConfig
 class PromptEnhanceService:
     def __init__(self, config: PromptEnhanceConfig):
         self.config = config
+        self.semaphore = asyncio.Semaphore(config.max_concurrent_requests)
 
     def enhance_prompt(self, user_prompt: str, pe_type: str) -> Optional[str]:
         raise Exception("Not implemented")
-    
+
+    async def enhance_prompt_async(self, user_prompt: str, pe_type: str) -> Optional[str]:
+        async with self.semaphore:
+            return await self._enhance_prompt_async(user_prompt, pe_type)
+
+    async def _enhance_prompt_async(self, user_prompt: str, pe_type: str) -> Optional[str]:
+        # services that only implement the synchronous API are run in a thread pool
+        return await asyncio.to_thread(self.enhance_prompt, user_prompt, pe_type)
+
+    async def close(self) -> None:
+        pass
+
+    def _retry_delay(self, attempt: int) -> float:
+        # exponential backoff with full jitter, so that requests that failed together are not retried together
+        return random.uniform(0, min(self.config.retry_max_delay, self.config.retry_delay * 2 ** attempt))
+
 
 class PromptEnhanceServiceFactory:
     _service_cache: Dict[str, Type] = {}
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from typing import List, Optional, Union
+
+from .config import ResultCacheConfig
+from . import logger
+
+# an image is stored as bytes until it was sent to Telegram, afterwards as its file_id
+CachedImage = Union[bytes, str]
+
+
+class ResultCache:
+    # final images of deterministic generations (seed set by the user), least recently used results are evicted
+    # when the cache is over its size or entry limit
+    def __init__(self, config: ResultCacheConfig):
+        self.config = config
+        self._entries: OrderedDict[str, List[CachedImage]] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __contains__(self, key: str) -> bool:
+        # not counted as a hit or a miss, the result is looked up with get when it is used
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[List[CachedImage]]:
+        images = self._entries.get(key)
+        if images is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return images
+
+    def put(self, key: str, images: List[CachedImage]) -> None:
+        self.forget(key)
+        size = _size(images)
+        if size > self.config.max_bytes:
+            return
+        self._entries[key] = images
+        self.size += size
+        while self.size > self.config.max_bytes or len(self._entries) > self.config.max_entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= _size(evicted)
+        logger.debug(f"Cached result {key[:12]} ({size} bytes), result cache size: {self.size} bytes in {len(self._entries)} results")
+
+    def forget(self, key: str) -> None:
+        images = self._entries.pop(key, None)
+        if images is not None:
+            self.size -= _size(images)
+
+
+def _size(images: List[CachedImage]) -> int:
+    return sum(len(image) for image in images)
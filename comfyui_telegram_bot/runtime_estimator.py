@@ -0,0 +1,69 @@
+from typing import TYPE_CHECKING, Dict, Hashable
+
+from .config import RuntimeEstimateConfig
+from . import logger
+
+if TYPE_CHECKING:
+    from .image_gen import GenerationParameters
+
+
+class _RuntimeFit:
+    # exponentially weighted linear regression of the duration on the work (megapixels x steps x images)
+    __slots__ = ("weight", "x", "y", "xx", "xy")
+
+    def __init__(self):
+        self.weight = self.x = self.y = self.xx = self.xy = 0.0
+
+    def add(self, work: float, seconds: float, decay: float) -> None:
+        self.weight = self.weight * decay + 1
+        self.x = self.x * decay + work
+        self.y = self.y * decay + seconds
+        self.xx = self.xx * decay + work * work
+        self.xy = self.xy * decay + work * seconds
+
+    def predict(self, work: float, overhead: float) -> float:
+        mean_x, mean_y = self.x / self.weight, self.y / self.weight
+        variance = self.xx / self.weight - mean_x * mean_x
+        if variance > 1e-6 * mean_x * mean_x:
+            slope = (self.xy / self.weight - mean_x * mean_y) / variance
+            intercept = mean_y - slope * mean_x
+            if slope > 0 and intercept >= 0:
+                return intercept + slope * work
+        # all observations had (about) the same work, the duration is scaled with the configured overhead
+        rate = max(mean_y - overhead, 0.0) / mean_x if mean_x > 0 else 0.0
+        return overhead + rate * work
+
+
+class RuntimeEstimator:
+    # predicts how long ComfyUI takes to execute a generation, learned from the durations of finished generations
+    # per sampler and LoRA, generations with a combination that was not seen yet use the fit of all generations
+    def __init__(self, config: RuntimeEstimateConfig):
+        self.config = config
+        self._fits: Dict[Hashable, _RuntimeFit] = {}
+        self._overall = _RuntimeFit()
+        self.observations = 0
+
+    @staticmethod
+    def work(gp: 'GenerationParameters') -> float:
+        return gp.width * gp.height / (1024 * 1024) * gp.steps * gp.latent_batch_size
+
+    @staticmethod
+    def _key(gp: 'GenerationParameters') -> Hashable:
+        return (gp.sampler, gp.lora)
+
+    def estimate(self, gp: 'GenerationParameters') -> float:
+        work = self.work(gp)
+        fit = self._fits.get(self._key(gp))
+        if fit is None and self._overall.weight > 0:
+            fit = self._overall
+        if fit is None:
+            return self.config.overhead + self.config.seconds_per_megapixel_step * work
+        return fit.predict(work, self.config.overhead)
+
+    def observe(self, gp: 'GenerationParameters', seconds: float) -> None:
+        work = self.work(gp)
+        decay = 1 - self.config.smoothing
+        logger.debug(f"Generation of {work:.1f} megapixel steps took {seconds:.1f}s (estimated {self.estimate(gp):.1f}s)")
+        self._fits.setdefault(self._key(gp), _RuntimeFit()).add(work, seconds, decay)
+        self._overall.add(work, seconds, decay)
+        self.observations += 1
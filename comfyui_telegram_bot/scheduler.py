@@ -0,0 +1,206 @@
+import asyncio
+from collections import deque
+import time
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+from .config import QueueConfig
+from .job_store import Job as Task
+from . import logger
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Scheduler:
+    def __init__(self, config: QueueConfig, run_task: Callable[[Task], Awaitable[None]],
+                 affinity_key: Callable[[Task], Hashable] = lambda task: None,
+                 preferred_affinity_keys: Callable[[], Set[Hashable]] = set,
+                 cost: Callable[[Task], float] = lambda task: 1.0):
+        if config.policy not in ("round_robin", "weighted_fair", "shortest_first"):
+            raise ValueError(f"Invalid queue policy '{config.policy}'")
+        self.config = config
+        self.run_task = run_task
+        # tasks with a preferred affinity key (e.g. a LoRA that is already loaded) may be started
+        # before tasks of users whose turn it is, a task can be skipped at most affinity_window times
+        self.affinity_key = affinity_key
+        self.preferred_affinity_keys = preferred_affinity_keys
+        # expected GPU seconds of a task, weighted fair queuing shares the GPU time between users
+        # and "shortest_first" starts the shortest of the tasks that are next in the queues of the users
+        self.cost = cost
+        self.pending: Dict[int, Deque[Task]] = {}
+        self.active: Dict[int, List[Task]] = {}
+        self._round_robin: Deque[int] = deque() # users with pending tasks
+        self._virtual_time: Dict[int, float] = {}
+        self._global_virtual_time = 0.0
+        self._last_affinity_key: Hashable = None
+        self._closed = False
+
+    @property
+    def active_count(self) -> int:
+        return sum(len(tasks) for tasks in self.active.values())
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(tasks) for tasks in self.pending.values())
+
+    def submit(self, user_id: int, tasks: List[Task]) -> None:
+        if not self.pending.get(user_id):
+            self.pending[user_id] = deque()
+            self._round_robin.append(user_id)
+            # users that were idle don't get to catch up on the time they were not using the GPU
+            self._virtual_time[user_id] = max(self._virtual_time.get(user_id, 0.0), self._global_virtual_time)
+        self.pending[user_id].extend(tasks)
+        self._dispatch()
+
+    def admit(self, user_id: int, task_count: int, cost: float) -> None:
+        # checked before the tasks of a request are submitted, resumed tasks are always accepted
+        user_task_count = len(self.tasks(user_id))
+        if user_task_count + task_count > self.config.max_tasks_per_user:
+            raise QueueFullError(f"You already have {user_task_count} task(s) in the queue and at most {self.config.max_tasks_per_user} are allowed. "
+                                 f"Wait for them to finish or cancel them with /cancelall.")
+        if self.active_count + self.pending_count + task_count > self.config.max_tasks:
+            raise QueueFullError("The queue is full right now, please try again later.")
+        if self.config.max_queued_gpu_seconds is not None:
+            queued = sum(self.cost(task) for tasks in [*self.active.values(), *self.pending.values()] for task in tasks)
+            if queued + cost > self.config.max_queued_gpu_seconds:
+                raise QueueFullError(f"The queue is too long right now (about {queued / 60:.0f} min of generations), please try again later.")
+
+    def resume(self, user_id: int, tasks: List[Task]) -> None:
+        # tasks that were submitted to ComfyUI before a restart are started right away
+        for task in tasks:
+            self.active.setdefault(user_id, []).append(task)
+            task.handle = asyncio.create_task(self._run_task(user_id, task))
+
+    def tasks(self, user_id: int) -> List[Task]:
+        return self.active.get(user_id, []) + list(self.pending.get(user_id, []))
+
+    def remove(self, user_id: int, task: Task) -> bool:
+        pending = self.pending.get(user_id)
+        if not pending or task not in pending:
+            return False
+        pending.remove(task)
+        if not pending:
+            self._remove_user(user_id)
+        return True
+
+    def global_order(self) -> List[Task]:
+        # simulates the scheduler to find out in which order the pending tasks will be started,
+        # the LoRAs loaded on the backends are assumed to stay the same
+        pending = {user_id: deque(tasks) for user_id, tasks in self.pending.items()}
+        round_robin = deque(self._round_robin)
+        virtual_time = dict(self._virtual_time)
+        last_affinity_key = self._last_affinity_key
+        preferred_keys = self.preferred_affinity_keys()
+        skipped: Dict[int, int] = {}
+        order = []
+        now = time.monotonic()
+        while True:
+            user_id, skipped_task = self._select_user(round_robin, virtual_time, pending, preferred_keys | {last_affinity_key},
+                                                      skipped, ignore_limits=True, now=now)
+            if user_id is None:
+                return order
+            if skipped_task is not None:
+                skipped[id(skipped_task)] = skipped.get(id(skipped_task), 0) + 1
+            task = pending[user_id].popleft()
+            order.append(task)
+            last_affinity_key = self.affinity_key(task)
+            self._advance(user_id, round_robin, virtual_time, task)
+            if not pending[user_id]:
+                round_robin.remove(user_id)
+
+    def global_positions(self) -> Dict[int, int]:
+        # positions are counted after the tasks that are already running (keyed by id of the task)
+        return {id(task): position for position, task in enumerate(self.global_order(), start=self.active_count + 1)}
+
+    def _weight(self, user_id: int) -> float:
+        return self.config.user_weights.get(user_id, 1.0)
+
+    def _candidate_users(self, round_robin: Deque[int], virtual_time: Dict[int, float], pending: Dict[int, Deque[Task]],
+                         ignore_limits: bool = False, now: Optional[float] = None) -> List[int]:
+        candidates = [
+            user_id for user_id in round_robin
+            if pending.get(user_id) and (ignore_limits or len(self.active.get(user_id, [])) < self.config.max_active_tasks_per_user)
+        ]
+        if self.config.policy == "weighted_fair":
+            # weighted fair queuing, the user whose next task would finish first in virtual time goes first
+            candidates.sort(key=lambda user_id: virtual_time[user_id] + self.cost(pending[user_id][0]) / self._weight(user_id))
+        elif self.config.policy == "shortest_first":
+            # tasks that waited longer than max_wait are not overtaken by shorter ones anymore
+            now = time.monotonic() if now is None else now
+            def priority(user_id: int) -> tuple:
+                head = pending[user_id][0]
+                if now - head.queued > self.config.max_wait:
+                    return (0, head.queued)
+                return (1, self.cost(head))
+            candidates.sort(key=priority)
+        return candidates
+
+    def _select_user(self, round_robin: Deque[int], virtual_time: Dict[int, float], pending: Dict[int, Deque[Task]],
+                     preferred_keys: Set[Hashable], skipped: Dict[int, int], ignore_limits: bool = False,
+                     now: Optional[float] = None) -> Tuple[Optional[int], Optional[Task]]:
+        # returns the user whose task is started next and the task that is skipped for it (if any),
+        # skipped counts skips that are not recorded in the tasks yet (keyed by id of the task)
+        candidates = self._candidate_users(round_robin, virtual_time, pending, ignore_limits, now)
+        if not candidates or self.config.affinity_window <= 0:
+            return (candidates[0] if candidates else None), None
+        head = pending[candidates[0]][0]
+        if self.affinity_key(head) in preferred_keys or head.skipped + skipped.get(id(head), 0) >= self.config.affinity_window:
+            return candidates[0], None
+        for user_id in candidates[1:self.config.affinity_window + 1]:
+            if self.affinity_key(pending[user_id][0]) in preferred_keys:
+                return user_id, head
+        return candidates[0], None
+
+    def _advance(self, user_id: int, round_robin: Deque[int], virtual_time: Dict[int, float], task: Task) -> float:
+        round_robin.remove(user_id)
+        round_robin.append(user_id)
+        virtual_time[user_id] += self.cost(task) / self._weight(user_id)
+        return virtual_time[user_id]
+
+    def _remove_user(self, user_id: int) -> None:
+        self.pending.pop(user_id, None)
+        if user_id in self._round_robin:
+            self._round_robin.remove(user_id)
+
+    def _dispatch(self) -> None:
+        while not self._closed and self.active_count < self.config.max_active_tasks:
+            user_id, skipped_task = self._select_user(self._round_robin, self._virtual_time, self.pending,
+                                                      self.preferred_affinity_keys() | {self._last_affinity_key}, {})
+            if user_id is None:
+                return
+            if skipped_task is not None:
+                skipped_task.skipped += 1
+            task = self.pending[user_id].popleft()
+            self._last_affinity_key = self.affinity_key(task)
+            self._global_virtual_time = max(self._global_virtual_time, self._virtual_time[user_id])
+            self._advance(user_id, self._round_robin, self._virtual_time, task)
+            if not self.pending[user_id]:
+                self._remove_user(user_id)
+            self.active.setdefault(user_id, []).append(task)
+            logger.info(f"Starting task for user {user_id}. Active tasks: {self.active_count}, pending tasks: {self.pending_count}")
+            task.handle = asyncio.create_task(self._run_task(user_id, task))
+
+    async def _run_task(self, user_id: int, task: Task) -> None:
+        cancelled = False
+        try:
+            await self.run_task(task)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            logger.error("Task failed with an unexpected error:", exc_info=e)
+        finally:
+            self.active[user_id].remove(task)
+            if not self.active[user_id]:
+                self.active.pop(user_id)
+            if not cancelled:
+                self._dispatch()
+
+    async def shutdown(self) -> None:
+        # the running tasks are cancelled and no other task is started, unfinished jobs are resumed after the restart
+        self._closed = True
+        handles = [task.handle for tasks in self.active.values() for task in tasks if task.handle is not None]
+        for handle in handles:
+            handle.cancel()
+        await asyncio.gather(*handles, return_exceptions=True)
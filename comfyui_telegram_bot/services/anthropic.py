@@ -1,5 +1,8 @@
+import asyncio
 import anthropic
 import re
+from typing import Optional
+import time
 from .. import logger
 
 from ..prompt_enhance import PromptEnhanceService
@@ -7,13 +10,15 @@ from ..prompt_enhance import PromptEnhanceService
 class AnthopicService(PromptEnhanceService):
     def __init__(self, config):
         super().__init__(config)
-        self.client = anthropic.Anthropic(api_key=self.config.api_key)
+        # retries are done by enhance_prompt, with a new request when the response does not contain a prompt
+        self.client = anthropic.Anthropic(api_key=self.config.api_key, timeout=self.config.timeout, max_retries=0)
+        self.async_client = anthropic.AsyncAnthropic(api_key=self.config.api_key, timeout=self.config.timeout, max_retries=0)
 
-    def _call_api(self, user_prompt: str, system_prompt: str) -> str:
-        message = self.client.messages.create(
-            model="claude-3-5-sonnet-20240620",
-            max_tokens=1000,
-            temperature=0,
+    def _create_message_kwargs(self, user_prompt: str, system_prompt: str) -> dict:
+        return dict(
+            model=self.config.model,
+            max_tokens=self.config.max_tokens,
+            temperature=self.config.temperature,
             system=system_prompt,
             messages=[
                 {
@@ -27,27 +32,68 @@ class AnthopicService(PromptEnhanceService):
                 }
             ]
         )
+
+    def _call_api(self, user_prompt: str, system_prompt: str) -> str:
+        message = self.client.messages.create(**self._create_message_kwargs(user_prompt, system_prompt))
         return message.content.pop().text
 
-    def enhance_prompt(self, user_prompt: str, pe_type: str) -> str:
+    async def _call_api_async(self, user_prompt: str, system_prompt: str) -> str:
+        message = await self.async_client.messages.create(**self._create_message_kwargs(user_prompt, system_prompt))
+        return message.content.pop().text
+
+    def _get_system_prompt(self, pe_type: str) -> str:
         type_config = self.config.types.get(pe_type)
         if type_config is None:
             raise Exception(f"Invalid prompt enhancement type '{pe_type}'")
-        system_prompt = type_config.system_prompt
+        return type_config.system_prompt
+
+    def _extract_prompt(self, response: str, attempt: int) -> Optional[str]:
+        prompt_match = re.search(r'<prompt>((.|\n)*?)</prompt>', response, re.DOTALL)
+        if prompt_match:
+            return prompt_match.group(1).strip()
+        logger.warning(f"Attempt {attempt + 1}: No prompt found between <prompt> tags.")
+        return None
+
+    def _should_retry(self, error: Exception, attempt: int) -> bool:
         retries = self.config.retries
-        for attempt in range(retries):
+        if isinstance(error, anthropic.APIStatusError) and error.status_code < 500 and error.status_code not in (408, 409, 429):
+            # invalid request or API key, retrying won't help
+            logger.error(f"Failed to create prompt. Error: {error}")
+            return False
+        if attempt == retries - 1:
+            logger.error(f"Failed to create prompt after {retries} attempts. Error: {error}")
+            return False
+        logger.warning(f"Attempt {attempt + 1} failed. Error: {error} Retrying...")
+        return True
+
+    def enhance_prompt(self, user_prompt: str, pe_type: str) -> str:
+        system_prompt = self._get_system_prompt(pe_type)
+        for attempt in range(self.config.retries):
             try:
-                prompt = self._call_api(user_prompt, system_prompt)
-                prompt_match = re.search(r'<prompt>((.|\n)*?)</prompt>', prompt, re.DOTALL)
-                if prompt_match:
-                    extracted_prompt = prompt_match.group(1).strip()
-                    return extracted_prompt
-                else:
-                    logger.warning(f"Attempt {attempt + 1}: No prompt found between <prompt> tags.")
+                prompt = self._extract_prompt(self._call_api(user_prompt, system_prompt), attempt)
+                if prompt is not None:
+                    return prompt
             except Exception as e:
-                if attempt == retries - 1:
-                    logger.error(f"Failed to create prompt after {retries} attempts. Error: {e}")
-                else:
-                    logger.warning(f"Attempt {attempt + 1} failed. Error: {e} Retrying...")
+                if not self._should_retry(e, attempt):
+                    break
+                time.sleep(self._retry_delay(attempt))
         logger.error("Failed to create a valid prompt after all attempts.")
-        raise Exception(f"Failed to generate enhanced prompt, please try again later.")
\ No newline at end of file
+        raise Exception(f"Failed to generate enhanced prompt, please try again later.")
+
+    async def _enhance_prompt_async(self, user_prompt: str, pe_type: str) -> str:
+        system_prompt = self._get_system_prompt(pe_type)
+        for attempt in range(self.config.retries):
+            try:
+                prompt = self._extract_prompt(await self._call_api_async(user_prompt, system_prompt), attempt)
+                if prompt is not None:
+                    return prompt
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    break
+                await asyncio.sleep(self._retry_delay(attempt))
+        logger.error("Failed to create a valid prompt after all attempts.")
+        raise Exception(f"Failed to generate enhanced prompt, please try again later.")
+
+    async def close(self) -> None:
+        await self.async_client.close()
+        self.client.close()
@@ -0,0 +1,191 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from telegram.error import RetryAfter, TelegramError
+
+from .config import StatusUpdatesConfig
+from . import logger
+
+# weight of a new measurement in the moving average of the edit latency
+LATENCY_SMOOTHING = 0.2
+
+
+class StatusUpdateScheduler:
+    # all edits of status messages share Telegram's rate limits, globally and per chat
+    def __init__(self, config: StatusUpdatesConfig):
+        self.config = config
+        self._next_global = 0.0
+        self._next_chat: Dict[int, float] = {}
+        self._updaters: Set['StatusUpdater'] = set()
+        self.caption_latency = 0.0
+        self.media_latency = 0.0
+        self.edits_sent = 0
+        self.edits_superseded = 0
+        self.retry_after_count = 0
+
+    def create(self, chat_id: int, edit_caption: Callable[..., Awaitable], edit_media: Callable[..., Awaitable]) -> 'StatusUpdater':
+        updater = StatusUpdater(self, chat_id, edit_caption, edit_media)
+        self._updaters.add(updater)
+        return updater
+
+    def preview_interval(self) -> float:
+        # previews are the slowest edits, every status message gets its share of the global edit rate
+        # and a preview is not sent more often than the previous one takes to upload
+        fair_share = len(self._updaters) / self.config.max_edits_per_second
+        return max(self.config.min_preview_interval, 2 * fair_share, 2 * self.media_latency)
+
+    async def acquire(self, chat_id: int) -> None:
+        while True:
+            now = time.monotonic()
+            wait = max(self._next_global, self._next_chat.get(chat_id, 0.0)) - now
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+        self._next_global = now + 1 / self.config.max_edits_per_second
+        self._next_chat[chat_id] = now + self.config.chat_interval
+
+    async def send(self, chat_id: int, send: Callable[[], Awaitable]) -> Optional[Any]:
+        # other messages of a job (e.g. about its prompt enhancement) share the rate limits, they are not needed
+        # for the generation, a message that could not be sent is skipped (None is returned)
+        for attempt in range(self.config.retries + 1):
+            await self.acquire(chat_id)
+            try:
+                return await send()
+            except RetryAfter as e:
+                self.record_retry_after(chat_id, _seconds(e.retry_after))
+            except TelegramError as e:
+                logger.warning(f"Failed to send a message to chat {chat_id}: {e}")
+                return None
+        logger.error(f"Failed to send a message to chat {chat_id}, Telegram rate limit reached")
+        return None
+
+    def record_edit(self, latency: float, media: bool) -> None:
+        self.edits_sent += 1
+        if media:
+            self.media_latency += LATENCY_SMOOTHING * (latency - self.media_latency)
+        else:
+            self.caption_latency += LATENCY_SMOOTHING * (latency - self.caption_latency)
+
+    def record_retry_after(self, chat_id: int, retry_after: float) -> None:
+        self.retry_after_count += 1
+        logger.warning(f"Telegram rate limit reached in chat {chat_id}, retrying after {retry_after}s")
+        self._next_chat[chat_id] = max(self._next_chat.get(chat_id, 0.0), time.monotonic() + retry_after)
+
+    def _remove(self, updater: 'StatusUpdater') -> None:
+        # the deadline of a chat outlives its status messages (a final edit is sent after close, a RetryAfter
+        # applies to the next message in the chat), only deadlines that passed are dropped
+        self._updaters.discard(updater)
+        now = time.monotonic()
+        active_chats = {other.chat_id for other in self._updaters}
+        for chat_id in [chat_id for chat_id, deadline in self._next_chat.items() if deadline <= now and chat_id not in active_chats]:
+            del self._next_chat[chat_id]
+
+
+class StatusUpdater:
+    # progress updates of one status message, an update that was not sent yet is replaced by a newer one
+    def __init__(self, scheduler: StatusUpdateScheduler, chat_id: int, edit_caption: Callable[..., Awaitable], edit_media: Callable[..., Awaitable]):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self._edit_caption = edit_caption
+        self._edit_media = edit_media
+        self._caption: Optional[str] = None
+        self._media: Optional[bytes] = None
+        self._sent_caption: Optional[str] = None
+        self._last_preview = 0.0
+        self._pending = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def update_caption(self, caption: str) -> None:
+        if self._caption is not None or self._media is not None:
+            self.scheduler.edits_superseded += 1
+        self._caption = caption
+        self._wake()
+
+    def update_preview(self, caption: str, media: bytes) -> None:
+        if self._caption is not None or self._media is not None:
+            self.scheduler.edits_superseded += 1
+        self._caption = caption
+        self._media = media
+        self._last_preview = time.monotonic()
+        self._wake()
+
+    def preview_due(self) -> bool:
+        return time.monotonic() - self._last_preview >= self.scheduler.preview_interval()
+
+    async def edit_caption(self, caption: str, **kwargs) -> None:
+        # final updates replace pending ones and are always sent
+        await self._send_final(lambda: self._edit_caption(caption, **kwargs), media=False)
+
+    async def edit_media(self, caption: str, media: bytes, **kwargs) -> None:
+        await self._send_final(lambda: self._edit_media(caption=caption, media=media, **kwargs), media=True)
+
+    async def close(self) -> None:
+        self._drop_pending()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.scheduler._remove(self)
+
+    def _wake(self) -> None:
+        self._pending.set()
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def _drop_pending(self) -> None:
+        if self._caption is not None or self._media is not None:
+            self.scheduler.edits_superseded += 1
+        self._caption = None
+        self._media = None
+
+    async def _send_final(self, edit: Callable[[], Awaitable], media: bool) -> None:
+        await self.close()
+        for attempt in range(self.scheduler.config.retries + 1):
+            await self.scheduler.acquire(self.chat_id)
+            try:
+                await self._timed(edit, media)
+                return
+            except RetryAfter as e:
+                self.scheduler.record_retry_after(self.chat_id, _seconds(e.retry_after))
+        logger.error(f"Failed to update the status message in chat {self.chat_id}, Telegram rate limit reached")
+
+    async def _run(self) -> None:
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            if self._media is None and self._caption == self._sent_caption:
+                self._caption = None
+                continue
+            await self.scheduler.acquire(self.chat_id)
+            # the newest state is sent, it might have changed while waiting for the rate limit
+            caption, media = self._caption, self._media
+            self._caption = None
+            self._media = None
+            if caption is None and media is None:
+                continue
+            try:
+                if media is not None:
+                    await self._timed(lambda: self._edit_media(caption=caption, media=media), media=True)
+                else:
+                    await self._timed(lambda: self._edit_caption(caption), media=False)
+                self._sent_caption = caption
+            except RetryAfter as e:
+                self.scheduler.record_retry_after(self.chat_id, _seconds(e.retry_after))
+                if self._caption is None and self._media is None:
+                    self._caption, self._media = caption, media
+                self._pending.set()
+            except TelegramError as e:
+                logger.warning(f"Failed to update the status message in chat {self.chat_id}: {e}")
+
+    async def _timed(self, edit: Callable[[], Awaitable], media: bool) -> None:
+        start = time.monotonic()
+        await edit()
+        self.scheduler.record_edit(time.monotonic() - start, media)
+
+
+def _seconds(retry_after) -> float:
+    return retry_after.total_seconds() if hasattr(retry_after, "total_seconds") else float(retry_after)
@@ -1,20 +1,36 @@
-import os
 import asyncio
-from telegram import Update, InputMediaPhoto, BotCommand
+from dataclasses import asdict, replace
+import time
+from typing import Dict, List, Optional, Tuple
+from telegram import Bot, Update, InputMediaPhoto, BotCommand, ReplyParameters
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from collections import deque
-from telegram.error import NetworkError, TimedOut
+from telegram.error import BadRequest, NetworkError, TelegramError, TimedOut
 from functools import wraps
 
 from .prompt_enhance import PromptEnhanceServiceFactory, PromptEnhanceService
-from .image_gen import ComfyUIImageGeneration, GenerationParameters
+from .prompt_cache import CachedPromptEnhanceService
+from .image_gen import ComfyUIImageGeneration, GenerationParameters, SubmittedGeneration
+from .job_store import Job, JobStore
+from .scheduler import QueueFullError, Scheduler
+from .status_updates import StatusUpdateScheduler
+from .metrics import MetricsServer, format_timings, metrics
 from .config import ModeConfig
 from . import logger, config
 
-img_gen = ComfyUIImageGeneration(config.image_generation)
+job_store = JobStore(config.queue.store_filepath)
+img_gen = ComfyUIImageGeneration(config.image_generation, client_id=job_store.client_id(),
+                                 on_running=lambda task: job_store.update(task.job_id, state='running'))
 pe_service: PromptEnhanceService = PromptEnhanceServiceFactory.create(config.prompt_enhancement.service, config=config.prompt_enhancement)
-
-user_queues = {}
+if config.prompt_enhancement.cache.enabled:
+    pe_service = CachedPromptEnhanceService(pe_service, config.prompt_enhancement.service, config.prompt_enhancement)
+status_updates = StatusUpdateScheduler(config.telegram_bot.status_updates)
+scheduler = Scheduler(config.queue, lambda task: run_task(task),
+                      affinity_key=lambda task: task.params.lora_key(),
+                      preferred_affinity_keys=img_gen.backends.loaded_lora_keys,
+                      cost=lambda task: img_gen.runtimes.estimate(task.params))
+# messages are addressed by chat and message id so that jobs can be resumed after a restart, set in post_init
+bot: Optional[Bot] = None
+metrics_server = MetricsServer(config.metrics, metrics) if config.metrics.enabled else None
 
 def async_retry(max_retries=3, initial_delay=1, backoff_factor=2):
     def decorator(func):
@@ -34,76 +50,141 @@ def async_retry(max_retries=3, initial_delay=1, backoff_factor=2):
     return decorator
 
 @async_retry()
-async def edit_caption_with_retry(message, **kwargs):
-    return await message.edit_caption(**kwargs)
+async def edit_caption_with_retry(chat_id, message_id, **kwargs):
+    return await bot.edit_message_caption(chat_id=chat_id, message_id=message_id, **kwargs)
+
+@async_retry()
+async def edit_media_with_retry(chat_id, message_id, **kwargs):
+    return await bot.edit_message_media(chat_id=chat_id, message_id=message_id, **kwargs)
 
 @async_retry()
-async def edit_media_with_retry(message, **kwargs):
-    return await message.edit_media(**kwargs)
+async def reply_media_group_with_retry(task: Job, **kwargs):
+    return await bot.send_media_group(task.chat_id, reply_parameters=reply_to(task), **kwargs)
+
+def reply_to(task: Job) -> ReplyParameters:
+    # the request message might have been deleted in the meantime
+    return ReplyParameters(message_id=task.message_id, allow_sending_without_reply=True)
+
+async def reply_text(task: Job, text: str, **kwargs):
+    return await bot.send_message(task.chat_id, text, reply_parameters=reply_to(task), **kwargs)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text('Hi! Send me a prompt and I\'ll generate an image using ComfyUI. You can queue multiple requests. For more information run /help')
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    if user_id in user_queues and user_queues[user_id]:
+    tasks = scheduler.tasks(user_id)
+    if tasks:
         logger.info(f"Cancelled the current generation for user {user_id}")
-        task = user_queues[user_id][0]
-        task['cancel'] = True
         await update.message.reply_text("Cancelling the current image generation...")
+        await cancel_tasks(user_id, tasks[:1])
     else:
         await update.message.reply_text("No active image generation to cancel.")
 
 async def cancelall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    if user_id in user_queues and user_queues[user_id]:
+    tasks = scheduler.tasks(user_id)
+    if tasks:
         logger.info(f"Cancelled all generations for user {user_id}")
-        task = user_queues[user_id][0]
-        task['cancel'] = True
-        user_queues[user_id] = deque([task])
+        await cancel_tasks(user_id, tasks)
         await update.message.reply_text("Cancelled all image generations!")
     else:
         await update.message.reply_text("No active image generation to cancel.")
 
+async def cancel_tasks(user_id: int, tasks: List[Job]) -> None:
+    submitted = []
+    enhancements = set()
+    for task in tasks:
+        task.cancel = True
+        if task.enhanced_prompt is not None:
+            enhancements.add(task.enhanced_prompt)
+        if scheduler.remove(user_id, task):
+            finish_job(task, 'cancelled')
+        elif task.submission is not None:
+            submitted.append(task)
+        elif task.handle is not None and not task.submitting:
+            # still waiting for the enhanced prompt or for the previous task, nothing was sent to ComfyUI yet
+            task.handle.cancel()
+    # the jobs of a request share their enhancement, it is cancelled once none of them needs it anymore
+    for enhancement in enhancements:
+        if all(other.cancel for other in scheduler.tasks(user_id) if other.enhanced_prompt is enhancement):
+            enhancement.cancel()
+    if not submitted:
+        return
+    # the prompts are removed from ComfyUI (interrupted or deleted from its queue) right away,
+    # the generations are woken up to update their status messages
+    try:
+        await img_gen.cancel_many([task.submission for task in submitted])
+    except Exception as e:
+        logger.error(f"Failed to cancel prompts in ComfyUI: {e!r}")
+    for task in submitted:
+        img_gen.wake(task.submission)
+
 async def queue_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    if user_id in user_queues:
-        queue = user_queues[user_id]
-        queue_length = len(queue)
-
-        if queue_length == 0:
-            await update.message.reply_text("Your queue is currently empty.")
-            return
-
-        status_message = f"You have {queue_length} task(s) in your queue:\n\n"
-
-        for i, task in enumerate(queue, start=1):
-            params: GenerationParameters = task["params"]
-            prompt = params.prompt
-            status = "Running" if task['running'] else "Pending"
-
-            max_prompt_length = 50
-            if len(prompt) > max_prompt_length:
-                prompt = prompt[:max_prompt_length] + "..."
-
-            status_message += (f"{i}. Status: {status}\n"
-                               f"   Prompt: {prompt}\n"
-                               f"   Dimensions: {params.width}x{params.height}\n\n")
+    tasks = scheduler.tasks(user_id)
+    if not tasks:
+        await update.message.reply_text("You don't have any tasks in your queue.")
+        return
 
-        if queue[0]['running']:
-            status_message += "The first task in your queue is currently being processed."
+    positions = scheduler.global_positions()
+    etas = queue_etas()
+    status_message = f"You have {len(tasks)} task(s) in your queue:\n\n"
+
+    for i, task in enumerate(tasks, start=1):
+        params: GenerationParameters = task.params
+        prompt = params.prompt
+        if task.running:
+            status = "Running"
+        elif id(task) in positions:
+            status = f"Pending (position {positions[id(task)]} in the global queue)"
         else:
-            status_message += "Your tasks are queued and will be processed in order."
-
-        await update.message.reply_text(status_message)
-    else:
-        await update.message.reply_text("You don't have any tasks in your queue.")
+            status = "Waiting for the GPU"
+
+        max_prompt_length = 50
+        if len(prompt) > max_prompt_length:
+            prompt = prompt[:max_prompt_length] + "..."
+
+        status_message += (f"{i}. Status: {status}\n"
+                           f"   Prompt: {prompt}\n"
+                           f"   Dimensions: {params.width}x{params.height}\n"
+                           f"   Expected to finish in: {format_duration(etas[id(task)])}\n")
+        if params.latent_batch_size > 1:
+            status_message += f"   Images: {params.latent_batch_size}\n"
+        status_message += "\n"
+
+    status_message += f"Tasks of all users: {scheduler.active_count} in progress, {scheduler.pending_count} pending."
+
+    await update.message.reply_text(status_message)
+
+def queue_etas() -> Dict[int, float]:
+    # seconds until each task is expected to be finished (keyed by id of the task), the backends execute
+    # the tasks in progress and then the pending tasks in the order the scheduler will start them,
+    # tasks run in parallel up to the limit of the scheduler and the number of backends that are available
+    now = time.monotonic()
+    parallel = max(min(config.queue.max_active_tasks, img_gen.backends.available_count), 1)
+    active = sorted((task for tasks in scheduler.active.values() for task in tasks), key=lambda task: (not task.running, task.job_id))
+    etas = {}
+    total = 0.0
+    for task in active + scheduler.global_order():
+        remaining = img_gen.runtimes.estimate(task.params)
+        if task.started is not None:
+            remaining = max(remaining - (now - task.started), 0.0)
+        total += remaining
+        etas[id(task)] = total / parallel
+    return etas
+
+def format_duration(seconds: float) -> str:
+    if seconds < 60:
+        return f"~{max(round(seconds), 1)} s"
+    if seconds < 3600:
+        return f"~{round(seconds / 60)} min"
+    return f"~{seconds / 3600:.1f} h"
 
 async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
-    if user_id not in user_queues:
-        user_queues[user_id] = deque()
 
+    start = time.perf_counter()
     try:
         params: GenerationParameters = GenerationParameters.from_message(user_id, update.message.text, config.image_generation)
     except Exception as e:
@@ -111,70 +192,264 @@ async def generate_image(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text(f"Invalid generation parameters: {e}")
         return
     
+    parse_seconds = time.perf_counter() - start
+    metrics.record("parse", parse_seconds)
     logger.info(f"Parsed message from {user_id} - {params}")
 
-    for _ in range(params.batch_size):
-        task = {
-            'update': update,
-            'context': context,
-            'cancel': False,
-            'running': False,
-            'params': params,
-        }
-        user_queues[user_id].append(task)
-
-    await update.message.reply_text(f"Your request has been queued. {params.batch_size} image(s) added to the queue. Total tasks in queue: {len(user_queues[user_id])}")
-
-    if len(user_queues[user_id]) == params.batch_size:
-        asyncio.create_task(process_user_queue(user_id))
-
-async def process_user_queue(user_id):
-    while user_queues[user_id]:
-        task = user_queues[user_id][0]
-        logger.info(f"Processing user queue for user {user_id}. Remaining tasks in queue: {len(user_queues[user_id])-1}")
-        await generate_image_task(task['update'], task['context'], task['params'])
-        user_queues[user_id].popleft()
-
-async def generate_image_task(update: Update, context: ContextTypes.DEFAULT_TYPE, params: GenerationParameters) -> None:
+    if config.image_generation.latent_batching:
+        latent_batch_sizes = params.split_batch(config.image_generation.max_latent_batch_size)
+    else:
+        latent_batch_sizes = [1] * params.batch_size
+
+    jobs_params = params.split_jobs(latent_batch_sizes)
+    # without prompt enhancement the final prompt is already known, generations that are in the result cache
+    # are answered right away instead of waiting for their turn in the queue
+    cached, queued = [], []
+    for job_params in jobs_params:
+        if not params.prompt_enhance and img_gen.has_cached_result(final_params(job_params)):
+            cached.append(job_params)
+        else:
+            queued.append(job_params)
+    if queued:
+        try:
+            scheduler.admit(user_id, len(queued), sum(img_gen.runtimes.estimate(job_params) for job_params in queued))
+        except QueueFullError as e:
+            logger.info(f"Rejected request of user {user_id} - {e}")
+            await update.message.reply_text(f"Your request was not accepted. {e}")
+            return
+
+    # only ids and the parameters of each job are kept, the update and the context are not referenced by the queue
+    tasks = []
+    chat_id, message_id = update.effective_chat.id, update.message.message_id
+    for job_params in cached + queued:
+        job_id = job_store.add(user_id, chat_id, message_id, asdict(job_params))
+        tasks.append(Job(job_id, chat_id, message_id, job_params, timings={"parse": parse_seconds}))
+
+    for task in tasks[:len(cached)]:
+        try:
+            answered = await send_cached_result(task, final_params(task.params))
+        except TelegramError as e:
+            logger.warning(f"Failed to send the cached result of job {task.job_id}: {e}")
+            answered = False
+        if answered:
+            finish_job(task, 'cached')
+            tasks.remove(task)
+    # a cached result that could not be sent is generated again
+    if not tasks:
+        return
+
+    total_tasks = len(scheduler.tasks(user_id)) + len(tasks)
+    image_count = sum(task.params.latent_batch_size for task in tasks)
+    await update.message.reply_text(f"Your request has been queued. {image_count} image(s) added to the queue. Total tasks in queue: {total_tasks}")
+    if params.prompt_enhance:
+        start_enhancement(tasks)
+    scheduler.submit(user_id, tasks)
+
+def start_enhancement(tasks: List[Job]) -> None:
+    # the jobs of a request have the same prompt, it is enhanced once for all of them
+    enhancement = asyncio.create_task(enhance_prompt(tasks))
+    for task in tasks:
+        task.enhanced_prompt = enhancement
+
+async def enhance_prompt(tasks: List[Job]) -> Optional[str]:
+    # started as soon as the tasks are queued, the service limits how many prompts are enhanced at the same time
+    params: GenerationParameters = tasks[0].params
+    logger.info("Waiting for enhanced prompt")
+    for task in tasks:
+        job_store.update(task.job_id, state='enhancing')
+    # one message per request, it is sent like the status updates without failing the jobs
+    waiting_message = await status_updates.send(tasks[0].chat_id, lambda: reply_text(tasks[0], "Waiting for enhanced prompt..."))
+
+    async def edit_waiting_message(text: str, **kwargs):
+        if waiting_message is not None:
+            await status_updates.send(tasks[0].chat_id, lambda: waiting_message.edit_text(text=text, **kwargs))
+
     try:
-        logger.info("Starting generate image task")
+        with metrics.span("enhance", tasks[0].timings):
+            prompt = await pe_service.enhance_prompt_async(params.prompt, params.prompt_enhance)
+    except asyncio.CancelledError:
+        if all(task.cancel for task in tasks):
+            await edit_waiting_message("Prompt enhancement cancelled.")
+        # otherwise the bot is shutting down, the prompt is enhanced again after the restart
+        raise
+    except Exception as e:
+        logger.error(f"Failed to enhance prompt: {e}")
+        await edit_waiting_message(str(e))
+        return None
+    logger.info(f"Received enhanced prompt: {prompt}")
+    for task in tasks:
+        task.timings["enhance"] = tasks[0].timings["enhance"]
+        job_store.update(task.job_id, state='pending', enhanced_prompt=prompt)
+    await edit_waiting_message(f"Enhanced prompt:\n```\n{prompt}\n```", parse_mode='MarkdownV2')
+    return prompt
+
+async def run_task(task: Job) -> None:
+    user_id = task.user_id
+    active_tasks = scheduler.active[user_id]
+    previous = active_tasks[active_tasks.index(task) - 1] if active_tasks[0] is not task else None
+    metrics.record("queue", time.monotonic() - task.queued, task.timings)
+    try:
+        state = await prepare_generation(task, previous) if task.submission is None else None
+        if state is None:
+            state = await generate_image_task(task)
+    except asyncio.CancelledError:
+        if not task.cancel:
+            # the bot is shutting down, the job stays unfinished and is resumed after the restart
+            raise
+        # cancelled by the user before anything was sent to ComfyUI
+        logger.info("Generation cancelled while preparing")
+        finish_job(task, 'cancelled')
+        if task.status_message_id is not None:
+            await edit_caption_with_retry(task.chat_id, task.status_message_id, caption="Image generation cancelled.")
+        return
+    except Exception:
+        finish_job(task, 'failed')
+        raise
+    finish_job(task, state)
+
+def finish_job(task: Job, state: str) -> None:
+    job_store.finish(task.job_id)
+    metrics.jobs.inc(state=state)
+    logger.debug(f"Job {task.job_id} {state}, timings: {format_timings(task.timings)}")
+
+async def prepare_generation(task: Job, previous: Optional[Job]) -> Optional[str]:
+    # returns None once the job was submitted to ComfyUI, otherwise its final state ("cached", "failed" or "cancelled")
+    params: GenerationParameters = task.params
+    try:
+        logger.info("Preparing generate image task")
         prompt = params.prompt_template_pre_pe.format(params.prompt)
         
         if params.prompt_enhance:
-            logger.info("Waiting for enhanced prompt")
-            waiting_message = await update.message.reply_text(text="Waiting for enhanced prompt...")
-            try:
-                prompt = pe_service.enhance_prompt(params.prompt, params.prompt_enhance)
-            except Exception as e:
-                logger.error(f"Failed to enhance prompt: {e}")
-                await waiting_message.edit_text(text=str(e))
-                return
-            logger.info(f"Received enhanced prompt: {prompt}")
-            await waiting_message.edit_text(text=f"Enhanced prompt:\n```\n{prompt}\n```", parse_mode='MarkdownV2')
-        
+            # usually already finished while the task was waiting in the queue, the enhancement is shared
+            # with the other jobs of the request and is not cancelled together with this job
+            prompt = await asyncio.shield(task.enhanced_prompt)
+            # from here on the enhanced prompt is part of the parameters
+            task.enhanced_prompt = None
+            if prompt is None:
+                return 'failed'
+
         prompt = params.prompt_template_post_pe.format(prompt)
         params.update_prompt(prompt)
 
-        logger.debug("Creating placeholder image")
-        placeholder_path = img_gen.create_placeholder_image(params)
-        
-        with open(placeholder_path, 'rb') as photo:
-            status_message = await update.message.reply_photo(photo=photo, caption="Preparing to generate image...")
-
-        os.remove(placeholder_path)
-
-        async def edit_caption_callback(caption: str, **kwargs):
-            return await edit_caption_with_retry(status_message, caption=caption, **kwargs)
-        
-        async def edit_media_callback(caption: str, media_path: str, **kwargs):
-            with open(media_path, 'rb') as photo:
-                await edit_media_with_retry(status_message, media=InputMediaPhoto(media=photo, caption=caption, **kwargs))
+        if previous is not None:
+            # keep the order of the user's queue in the ComfyUI queue
+            await previous.wait_submitted()
+        if task.cancel:
+            return 'cancelled'
+        if await send_cached_result(task, params):
+            return 'cached'
+
+        # from here on a cancellation is handled once the workflow is in the ComfyUI queue
+        task.submitting = True
+        if task.status_message_id is None:
+            logger.debug("Creating placeholder image")
+            with metrics.span("placeholder", task.timings):
+                status_message = await send_placeholder(task)
+            task.status_message_id = status_message.message_id
+            job_store.update(task.job_id, status_message_id=status_message.message_id)
+        else:
+            # a resumed job that ComfyUI lost, its status message is reused
+            await edit_caption_with_retry(task.chat_id, task.status_message_id, caption="Preparing to generate image...")
+
+        with metrics.span("submit", task.timings):
+            submission = await img_gen.submit(params)
+        task.submission = submission
+        job_store.update(task.job_id, state='submitted', submitted_params=asdict(params), prompt_id=submission.prompt_id,
+                         backend=submission.backend.name, workflow=submission.workflow)
+        if task.cancel:
+            img_gen.wake(submission)
+        return None
 
-        await img_gen.generate_image(params, edit_caption_callback, edit_media_callback, user_queues)
+    except Exception as e:
+        logger.error("While preparing image generation an error occurred:", exc_info=e)
+        if task.status_message_id is not None:
+            await edit_caption_with_retry(task.chat_id, task.status_message_id, caption=f"An error occurred: {e}")
+        else:
+            await reply_text(task, f"An error occurred: {e}")
+        return 'failed'
+    finally:
+        task.set_submitted()
+
+async def send_placeholder(task: Job):
+    params: GenerationParameters = task.params
+    placeholder = img_gen.placeholder_image(params)
+    try:
+        message = await bot.send_photo(task.chat_id, photo=placeholder, caption="Preparing to generate image...", reply_parameters=reply_to(task))
+    except BadRequest:
+        if not isinstance(placeholder, str):
+            raise
+        # the file_id of the placeholder is not valid anymore, it is uploaded again
+        img_gen.set_placeholder_file_id(params, None)
+        placeholder = img_gen.placeholder_image(params)
+        message = await bot.send_photo(task.chat_id, photo=placeholder, caption="Preparing to generate image...", reply_parameters=reply_to(task))
+    if isinstance(placeholder, bytes):
+        img_gen.set_placeholder_file_id(params, message.photo[-1].file_id)
+    return message
+
+def final_params(params: GenerationParameters) -> GenerationParameters:
+    # the parameters of a job without prompt enhancement with the prompt as it is submitted to ComfyUI
+    prompt = params.prompt_template_post_pe.format(params.prompt_template_pre_pe.format(params.prompt))
+    return replace(params, prompt=prompt)
+
+async def send_cached_result(task: Job, params: GenerationParameters) -> bool:
+    # a generation with a seed set by the user that was already generated is answered without ComfyUI
+    images = img_gen.cached_result(params)
+    if images is None:
+        return False
+    caption = img_gen.final_caption(params, len(images))
+    try:
+        if len(images) == 1:
+            messages = [await bot.send_photo(task.chat_id, photo=images[0], caption=caption, parse_mode='MarkdownV2', reply_parameters=reply_to(task))]
+        else:
+            album = [
+                InputMediaPhoto(media=photo, caption=caption, parse_mode='MarkdownV2') if i == 0 else InputMediaPhoto(media=photo)
+                for i, photo in enumerate(images)
+            ]
+            messages = await bot.send_media_group(task.chat_id, media=album, reply_parameters=reply_to(task))
+    except BadRequest:
+        if all(isinstance(image, bytes) for image in images):
+            raise
+        # the file_ids are not valid anymore, the images are generated again
+        img_gen.set_result_file_ids(params, None)
+        return False
+    logger.info(f"Answered job {task.job_id} from the result cache")
+    img_gen.set_result_file_ids(params, [message.photo[-1].file_id for message in messages])
+    if task.status_message_id is not None:
+        # a resumed job, its status message is not needed anymore
+        await bot.delete_message(task.chat_id, task.status_message_id)
+    return True
+
+async def generate_image_task(task: Job) -> str:
+    chat_id, status_message_id = task.chat_id, task.status_message_id
+    submission: SubmittedGeneration = task.submission
+    params: GenerationParameters = task.params
+
+    async def edit_caption_callback(caption: str, **kwargs):
+        return await edit_caption_with_retry(chat_id, status_message_id, caption=caption, **kwargs)
+
+    async def edit_media_callback(caption: str, media: bytes, **kwargs):
+        await edit_media_with_retry(chat_id, status_message_id, media=InputMediaPhoto(media=media, caption=caption, **kwargs))
+
+    async def send_media_group_callback(caption: str, media: List[bytes], **kwargs):
+        # all images of a latent batch are sent together as an album, replacing the status message
+        album = [
+            InputMediaPhoto(media=photo, caption=caption, **kwargs) if i == 0 else InputMediaPhoto(media=photo)
+            for i, photo in enumerate(media)
+        ]
+        await reply_media_group_with_retry(task, media=album)
+        await bot.delete_message(chat_id, status_message_id)
+
+    status = status_updates.create(chat_id, edit_caption_callback, edit_media_callback)
+    try:
+        logger.info("Starting generate image task")
+        return await img_gen.generate_image(params, submission, task, status, send_media_group_callback)
 
     except Exception as e:
         logger.error("While generating image an error occurred:", exc_info=e)
-        await edit_caption_with_retry(status_message, caption=f"An error occurred: {e}")
+        await status.edit_caption(f"An error occurred: {e}")
+        return 'failed'
+    finally:
+        await status.close()
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     mode_descriptions = []
@@ -251,9 +526,110 @@ async def post_init(application: Application) -> None:
         BotCommand("status", "Check queue status"),
     ]
     await application.bot.set_my_commands(commands)
+    global bot
+    bot = application.bot
+    await img_gen.start()
+    register_metrics()
+    if metrics_server is not None:
+        await metrics_server.start()
+    await resume_jobs()
+
+def register_metrics() -> None:
+    # counters that the components keep themselves are read when the metrics are requested
+    metrics.callback("bot_queue_pending_tasks", "Tasks waiting in the queue", lambda: scheduler.pending_count)
+    metrics.callback("bot_queue_active_tasks", "Tasks in progress", lambda: scheduler.active_count)
+    metrics.callback("bot_telegram_retry_after_total", "Telegram rate limit responses (429) to status updates",
+                     lambda: status_updates.retry_after_count, "counter")
+    metrics.callback("bot_status_edits_total", "Status message edits sent", lambda: status_updates.edits_sent, "counter")
+    metrics.callback("bot_status_edits_superseded_total", "Status message edits replaced by newer ones before being sent",
+                     lambda: status_updates.edits_superseded, "counter")
+    metrics.callback("bot_lora_reloads_total", "Prompts that needed ComfyUI to load a different LoRA",
+                     lambda: img_gen.backends.lora_reloads, "counter")
+    metrics.callback("bot_lora_reloads_avoided_total", "Prompts that used the LoRA that was already loaded",
+                     lambda: img_gen.backends.lora_reloads_avoided, "counter")
+    if isinstance(pe_service, CachedPromptEnhanceService):
+        metrics.callback("bot_prompt_cache_hits_total", "Enhanced prompts answered from the cache", lambda: pe_service.cache.hits, "counter")
+        metrics.callback("bot_prompt_cache_misses_total", "Enhanced prompts requested from the LLM", lambda: pe_service.cache.misses, "counter")
+    if img_gen.results is not None:
+        metrics.callback("bot_result_cache_hits_total", "Generations answered from the result cache", lambda: img_gen.results.hits, "counter")
+        metrics.callback("bot_result_cache_misses_total", "Generations with a set seed that were not in the result cache",
+                         lambda: img_gen.results.misses, "counter")
+        metrics.callback("bot_result_cache_bytes", "Size of the result cache", lambda: img_gen.results.size)
+
+async def resume_jobs() -> None:
+    # jobs that were not finished when the bot stopped, prompts ComfyUI still has are followed again instead of being resubmitted
+    resumed: Dict[int, List[Job]] = {}
+    pending: Dict[int, List[Job]] = {}
+    chats: Dict[int, int] = {}
+    for job in job_store.unfinished():
+        task = Job(job['id'], job['chat_id'], job['message_id'], GenerationParameters(**job['params']),
+                   status_message_id=job['status_message_id'])
+        user_id = task.user_id
+        if job['prompt_id'] is not None:
+            try:
+                submission, running = await img_gen.reattach(job['prompt_id'], job['backend'], job['workflow'])
+            except Exception as e:
+                logger.error(f"Failed to resume job {job['id']} (prompt {job['prompt_id']}): {e!r}")
+                finish_job(task, 'failed')
+                try:
+                    await reply_text(task, "Your generation could not be resumed after a restart of the bot, please send it again.")
+                except TelegramError as e:
+                    logger.warning(f"Failed to notify chat {task.chat_id} about a job that could not be resumed: {e}")
+                continue
+            if submission is not None:
+                task.params = GenerationParameters(**job['submitted_params'])
+                task.submission = submission
+                task.running = running
+                task.set_submitted()
+                resumed.setdefault(user_id, []).append(task)
+                chats[task.chat_id] = chats.get(task.chat_id, 0) + 1
+                continue
+            # ComfyUI does not have the prompt anymore (e.g. it was restarted), it is submitted again
+            job_store.update(job['id'], state='pending', submitted_params=None, prompt_id=None, backend=None,
+                             workflow=None)
+        if job['enhanced_prompt'] is not None:
+            task.enhanced_prompt = asyncio.get_running_loop().create_future()
+            task.enhanced_prompt.set_result(job['enhanced_prompt'])
+        pending.setdefault(user_id, []).append(task)
+        chats[task.chat_id] = chats.get(task.chat_id, 0) + 1
+
+    for user_id, tasks in resumed.items():
+        scheduler.resume(user_id, tasks)
+    for user_id, tasks in pending.items():
+        requests: Dict[Tuple[int, int], List[Job]] = {}
+        for task in tasks:
+            if task.params.prompt_enhance and task.enhanced_prompt is None:
+                requests.setdefault((task.chat_id, task.message_id), []).append(task)
+        for request_tasks in requests.values():
+            start_enhancement(request_tasks)
+        scheduler.submit(user_id, tasks)
+    if chats:
+        logger.info(f"Resumed {sum(len(tasks) for tasks in resumed.values())} running and {sum(len(tasks) for tasks in pending.values())} pending jobs")
+    for chat_id, count in chats.items():
+        try:
+            await bot.send_message(chat_id, f"The bot was restarted, {count} of your task(s) were resumed.")
+        except TelegramError as e:
+            logger.warning(f"Failed to notify chat {chat_id} about resumed tasks: {e}")
+
+async def post_stop(application: Application) -> None:
+    # runs while the bot can still send messages, generations that finish in the meantime are delivered
+    # and the stopped jobs stay unfinished to be resumed after the restart
+    enhancements = {task.enhanced_prompt for tasks in [*scheduler.active.values(), *scheduler.pending.values()] for task in tasks
+                    if isinstance(task.enhanced_prompt, asyncio.Task)}
+    await scheduler.shutdown()
+    for enhancement in enhancements:
+        enhancement.cancel()
+    await asyncio.gather(*enhancements, return_exceptions=True)
+
+async def post_shutdown(application: Application) -> None:
+    if metrics_server is not None:
+        await metrics_server.close()
+    await img_gen.close()
+    await pe_service.close()
+    job_store.close()
 
 def main() -> None:
-    application = Application.builder().token(config.telegram_bot.token).post_init(post_init).build()
+    application = Application.builder().token(config.telegram_bot.token).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown).build()
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -0,0 +1,80 @@
+from copy import deepcopy
+import json
+import re
+from typing import Any, Dict, List
+
+from .config import ImageGenerationConfig
+
+# bindings whose values come from the config, they are set when the workflow is compiled
+STATIC_BINDINGS = ("model", "vae", "clip_t5", "clip_l")
+
+SLOT_PATTERN = re.compile(r'"@@slot:(\w+)@@"')
+
+
+class WorkflowTemplate:
+    # a workflow serialized once, only the values that differ between generations are spliced into it
+    def __init__(self, nodes: dict, slots: Dict[str, List[str]]):
+        skeleton = deepcopy(nodes)
+        for name, (node_id, input_name) in slots.items():
+            skeleton[node_id]["inputs"][input_name] = f"@@slot:{name}@@"
+        parts = SLOT_PATTERN.split(json.dumps(skeleton))
+        self._parts: List[str] = parts[0::2]
+        self._slot_names: List[str] = parts[1::2]
+        # the structure of the workflow (node titles and classes), slot inputs contain placeholders
+        self.nodes = skeleton
+
+    def render(self, values: Dict[str, Any]) -> str:
+        rendered = [self._parts[0]]
+        for name, part in zip(self._slot_names, self._parts[1:]):
+            rendered.append(json.dumps(values[name]))
+            rendered.append(part)
+        return "".join(rendered)
+
+
+def compile_workflow(workflow: dict, config: ImageGenerationConfig, lora: bool) -> WorkflowTemplate:
+    nodes_config = config.workflow
+    workflow = deepcopy(workflow)
+
+    if not lora and nodes_config.lora_node is not None:
+        _bypass_node(workflow, nodes_config.lora_node)
+
+    if config.output_mode == "websocket":
+        # the final images are sent over the websocket, they are stored only if save_images is set
+        removed = [nodes_config.preview_image_node] + ([] if config.save_images else [nodes_config.save_image_node])
+    else:
+        removed = [nodes_config.websocket_image_node] + [nodes_config.preview_image_node if config.save_images else nodes_config.save_image_node]
+    for node_id in removed:
+        if node_id is not None:
+            workflow.pop(node_id, None)
+
+    static_values = {"model": config.model, "vae": config.vae, "clip_t5": config.clip_t5, "clip_l": config.clip_l}
+    slots = {}
+    for name, binding in nodes_config.bindings.items():
+        if binding is None:
+            continue
+        node_id, input_name = binding
+        if node_id not in workflow:
+            if node_id == nodes_config.lora_node and not lora:
+                continue
+            raise ValueError(f"Workflow binding '{name}' refers to node {node_id} which is not in the workflow")
+        if name in STATIC_BINDINGS:
+            workflow[node_id]["inputs"][input_name] = static_values[name]
+        else:
+            slots[name] = binding
+    return WorkflowTemplate(workflow, slots)
+
+
+def _bypass_node(workflow: dict, node_id: str) -> None:
+    # links to the outputs of the node are connected to its linked inputs instead (in order),
+    # for a LoRA loader the model (and clip) outputs are connected to the model (and clip) it loads the LoRA into
+    node = workflow.pop(node_id)
+    linked_inputs = [value for value in node["inputs"].values() if is_link(value)]
+    for other in workflow.values():
+        for name, value in other["inputs"].items():
+            if is_link(value) and value[0] == node_id:
+                other["inputs"][name] = list(linked_inputs[value[1]])
+
+
+def is_link(value) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str)
+
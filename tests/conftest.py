@@ -0,0 +1,14 @@
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# the package reads config.yaml (and the workflow file) from the working directory when it is imported
+_directory = Path(tempfile.mkdtemp(prefix="comfyui_telegram_bot_tests_"))
+shutil.copy(ROOT / "config.example.yaml", _directory / "config.yaml")
+shutil.copy(ROOT / "workflow_api.json", _directory / "workflow_api.json")
+os.chdir(_directory)
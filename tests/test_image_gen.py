@@ -0,0 +1,98 @@
+import asyncio
+
+from comfyui_telegram_bot import config
+from comfyui_telegram_bot.comfyui_websocket import ComfyUIWebsocket
+from comfyui_telegram_bot.config import StatusUpdatesConfig
+from comfyui_telegram_bot.image_gen import ComfyUIImageGeneration, GenerationParameters, SubmittedGeneration
+from comfyui_telegram_bot.job_store import Job
+from comfyui_telegram_bot.previews import FRAME_HEADER
+from comfyui_telegram_bot.status_updates import StatusUpdateScheduler
+
+
+class FakeClient:
+    def __init__(self, running, pending):
+        self.queue = {"queue_running": [[0, prompt_id] for prompt_id in running],
+                      "queue_pending": [[1, prompt_id] for prompt_id in pending]}
+        self.fail_interrupt = False
+        self.deleted = []
+        self.interrupted = []
+
+    async def get_queue(self):
+        return self.queue
+
+    async def delete_queued(self, prompt_ids):
+        self.deleted.append(prompt_ids)
+
+    async def interrupt(self, prompt_id=None):
+        if self.fail_interrupt:
+            raise Exception("ComfyUI is not reachable")
+        self.interrupted.append(prompt_id)
+
+
+class FakeBackend:
+    def __init__(self, client):
+        self.name = "fake"
+        self.client = client
+        self.websocket = ComfyUIWebsocket("ws://localhost", config.image_generation.client)
+
+
+def test_cancel_keeps_following_prompts_when_interrupt_fails():
+    async def run():
+        img_gen = ComfyUIImageGeneration(config.image_generation)
+        client = FakeClient(running=["running"], pending=["queued"])
+        backend = FakeBackend(client)
+        submissions = [SubmittedGeneration(prompt_id, {}, backend.websocket.subscribe(prompt_id), backend)
+                       for prompt_id in ("running", "queued")]
+
+        client.fail_interrupt = True
+        try:
+            await img_gen.cancel_many(submissions)
+        except Exception:
+            pass
+        else:
+            raise AssertionError("the failed interrupt was not reported")
+        assert not any(submission.cancelled for submission in submissions)
+        assert set(backend.websocket._subscribers) == {"running", "queued"}
+
+        client.fail_interrupt = False
+        await img_gen.cancel_many(submissions)
+        assert all(submission.cancelled for submission in submissions)
+        assert backend.websocket._subscribers == {}
+        assert client.interrupted == ["running"]
+
+        # generations that were cancelled already are not cancelled again
+        await img_gen.cancel_many(submissions)
+        assert client.interrupted == ["running"]
+
+    asyncio.run(run())
+
+
+def test_received_images_are_released_once_sent():
+    async def run():
+        img_gen = ComfyUIImageGeneration(config.image_generation)
+        backend = FakeBackend(FakeClient(running=[], pending=[]))
+        workflow = {"9": {"class_type": "SaveImageWebsocket", "inputs": {}, "_meta": {"title": "Save Image"}}}
+        submission = SubmittedGeneration("prompt", workflow, backend.websocket.subscribe("prompt"), backend)
+        for message in [{"type": "execution_start", "data": {"prompt_id": "prompt"}},
+                        {"type": "executing", "data": {"node": "9", "prompt_id": "prompt"}},
+                        FRAME_HEADER.pack(1, 2) + b"image",
+                        {"type": "execution_success", "data": {"prompt_id": "prompt"}}]:
+            submission.messages.put_nowait(message)
+        params = GenerationParameters.from_message(1, "a cat", config.image_generation)
+        task = Job(1, 1, 1, params, submission=submission)
+        sent = []
+
+        async def edit_caption(caption, **kwargs):
+            pass
+
+        async def edit_media(caption, media, **kwargs):
+            sent.append(media)
+
+        status = StatusUpdateScheduler(StatusUpdatesConfig()).create(1, edit_caption, edit_media)
+        state = await img_gen.generate_image(params, submission, task, status, None)
+        return state, sent, submission
+
+    state, sent, submission = asyncio.run(run())
+    assert state == "done"
+    assert sent == [b"image"]
+    assert submission.received_images == []
@@ -0,0 +1,43 @@
+import asyncio
+from dataclasses import asdict
+
+from comfyui_telegram_bot import config
+from comfyui_telegram_bot.image_gen import GenerationParameters
+from comfyui_telegram_bot.job_store import Job, JobStore
+
+
+def make_job(job_id: int = 1) -> Job:
+    return Job(job_id, 1, job_id, GenerationParameters.from_message(1, "a cat", config.image_generation))
+
+
+def test_submission_event_is_only_created_for_waiting_jobs():
+    async def run():
+        previous = make_job()
+        assert previous._submitted_event is None
+        waiting = asyncio.create_task(previous.wait_submitted())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        previous.set_submitted()
+        await asyncio.wait_for(waiting, 1)
+
+        submitted = make_job(2)
+        submitted.set_submitted()
+        await asyncio.wait_for(submitted.wait_submitted(), 1)
+        assert submitted._submitted_event is None
+
+    asyncio.run(run())
+
+
+def test_finished_jobs_are_removed(tmp_path):
+    store = JobStore(str(tmp_path / "jobs.sqlite3"))
+    params = asdict(GenerationParameters.from_message(1, "a cat", config.image_generation))
+    finished = store.add(1, 10, 5, params)
+    unfinished = store.add(1, 10, 6, params)
+    store.update(finished, state='submitted', workflow={"6": {}})
+    store.finish(finished)
+    # a late update of a finished job (e.g. from its prompt enhancement) does not bring it back
+    store.update(finished, state='pending')
+
+    assert [job['id'] for job in store.unfinished()] == [unfinished]
+    assert store._db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 1
+    store.close()
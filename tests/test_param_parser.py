@@ -0,0 +1,49 @@
+import pytest
+
+from benchmarks.param_parser import CORPUS, legacy_parse_message
+from comfyui_telegram_bot.param_parser import ParameterError, parse_message
+
+
+@pytest.mark.parametrize("message", CORPUS + [
+    "a cat",
+    "s=20 a cat 2x",
+    "a cat 2x 3x",
+    "a cat pe=default m=real seed=0",
+    "an axe 512x768",
+])
+def test_valid_messages_are_parsed_like_before(message):
+    parsed = parse_message(message)
+    assert (parsed.prompt, parsed.params) == legacy_parse_message(message)
+
+
+def test_parameters_are_cut_out_at_their_position():
+    # the previous parser removed the first occurrence of the matched text, here "2x" inside of "t2x"
+    parsed = parse_message("a robot named t2x 2x")
+    assert parsed.prompt == "a robot named t2x"
+    assert parsed.params == {"batch_size": 2}
+    assert parsed.positions == {"batch_size": 18}
+    assert legacy_parse_message("a robot named t2x 2x")[0] == "a robot named t 2x"
+
+
+@pytest.mark.parametrize("message, error, position", [
+    # known parameter names with a value that is not valid were kept in the prompt by the previous parser
+    ("a sign saying s=hello", "Invalid parameter 's=hello'", 14),
+    ("a cat m=real2", "Invalid parameter 'm=real2'", 6),
+    ("a cat seed=", "Invalid parameter 'seed='", 6),
+    ("a cat cfg=high 2x", "Invalid parameter 'cfg=high'", 6),
+    # values that match the pattern but can't be used
+    ("a cat 0x512", "Invalid size 0x512", 6),
+    ("a cat 16:0", "Invalid ratio 16:0", 6),
+    ("a cat 0MP", "Invalid mp count 0", 6),
+    ("a cat 0x", "Invalid batch size 0", 6),
+    ("a cat s=0", "Invalid steps 0", 6),
+])
+def test_invalid_parameters_are_rejected_with_their_position(message, error, position):
+    with pytest.raises(ParameterError) as info:
+        parse_message(message)
+    assert info.value.position == position
+    assert str(info.value) == f"{error} (at character {position + 1})"
+
+
+def test_previous_parser_kept_invalid_parameters_in_the_prompt():
+    assert legacy_parse_message("a sign saying s=hello") == ("a sign saying s=hello", {})
@@ -0,0 +1,180 @@
+import asyncio
+import time
+
+import pytest
+
+from comfyui_telegram_bot import config
+from comfyui_telegram_bot.config import QueueConfig
+from comfyui_telegram_bot.image_gen import GenerationParameters
+from comfyui_telegram_bot.job_store import Job
+from comfyui_telegram_bot.scheduler import QueueFullError, Scheduler
+
+
+def make_task(job_id: int, user_id: int) -> Job:
+    return Job(job_id, user_id, job_id, GenerationParameters.from_message(user_id, "a cat", config.image_generation))
+
+
+def start_order(queue_config: QueueConfig, requests, cost=lambda task: 1.0, prepare=lambda tasks: None):
+    # requests are (user id, job ids), they are queued while the task of user 0 is running,
+    # afterwards the tasks are finished one at a time and the order they were started in is returned
+    async def run():
+        started = []
+        finished = {}
+
+        async def run_task(task):
+            started.append(task.job_id)
+            finished[task.job_id] = asyncio.Event()
+            await finished[task.job_id].wait()
+
+        scheduler = Scheduler(queue_config, run_task, cost=cost)
+        scheduler.submit(0, [make_task(-1, 0)])
+        tasks = {user_id: [make_task(job_id, user_id) for job_id in job_ids] for user_id, job_ids in requests}
+        prepare(tasks)
+        for user_id, user_tasks in tasks.items():
+            scheduler.submit(user_id, user_tasks)
+        total = 1 + sum(len(job_ids) for _, job_ids in requests)
+        await asyncio.sleep(0)
+        while len(started) < total:
+            finished[started[-1]].set()
+            await asyncio.sleep(0.01)
+        return started[1:]
+
+    return asyncio.run(run())
+
+
+def test_round_robin_alternates_between_users():
+    order = start_order(QueueConfig(policy="round_robin", max_active_tasks=1),
+                        [(1, [0, 1, 2]), (2, [3, 4]), (3, [5])])
+    assert order == [0, 3, 5, 1, 4, 2]
+
+
+def test_weighted_fair_shares_the_gpu_time_by_weight():
+    order = start_order(QueueConfig(policy="weighted_fair", max_active_tasks=1, user_weights={1: 2}),
+                        [(1, list(range(0, 6))), (2, list(range(10, 16)))])
+    # user 1 has twice the weight of user 2, it gets twice as many of the tasks of the same cost
+    assert sum(job_id < 10 for job_id in order[:6]) == 4
+
+    # a user with expensive tasks gets fewer of them
+    costs = {**{job_id: 4.0 for job_id in range(0, 6)}, **{job_id: 1.0 for job_id in range(10, 16)}}
+    order = start_order(QueueConfig(policy="weighted_fair", max_active_tasks=1),
+                        [(1, list(range(0, 6))), (2, list(range(10, 16)))], cost=lambda task: costs.get(task.job_id, 1.0))
+    assert sum(job_id < 10 for job_id in order[:5]) == 1
+
+
+def test_shortest_first_starts_the_shortest_task_unless_one_waited_too_long():
+    costs = {0: 10.0, 1: 1.0, 2: 5.0}
+    order = start_order(QueueConfig(policy="shortest_first", max_active_tasks=1),
+                        [(1, [0]), (2, [1]), (3, [2])], cost=lambda task: costs.get(task.job_id, 1.0))
+    assert order == [1, 2, 0]
+
+    def waited_too_long(tasks):
+        tasks[1][0].queued = time.monotonic() - 1000
+
+    order = start_order(QueueConfig(policy="shortest_first", max_active_tasks=1, max_wait=600),
+                        [(1, [0]), (2, [1]), (3, [2])], cost=lambda task: costs.get(task.job_id, 1.0), prepare=waited_too_long)
+    assert order == [0, 1, 2]
+
+
+def test_active_tasks_are_limited_per_user_and_globally():
+    async def run(queue_config, requests):
+        async def run_task(task):
+            await asyncio.sleep(100)
+
+        scheduler = Scheduler(queue_config, run_task)
+        for user_id, job_ids in requests:
+            scheduler.submit(user_id, [make_task(job_id, user_id) for job_id in job_ids])
+        active = {user_id: [task.job_id for task in tasks] for user_id, tasks in scheduler.active.items()}
+        pending = scheduler.pending_count
+        await scheduler.shutdown()
+        return active, pending
+
+    active, pending = asyncio.run(run(QueueConfig(max_active_tasks=3, max_active_tasks_per_user=1),
+                                      [(1, [0, 1, 2]), (2, [3])]))
+    assert active == {1: [0], 2: [3]}
+    assert pending == 2
+
+    active, pending = asyncio.run(run(QueueConfig(max_active_tasks=2, max_active_tasks_per_user=2),
+                                      [(1, [0]), (2, [1]), (3, [2])]))
+    assert active == {1: [0], 2: [1]}
+    assert pending == 1
+
+
+def test_admit_rejects_requests_when_the_queue_is_full():
+    async def run():
+        async def run_task(task):
+            await asyncio.sleep(100)
+
+        scheduler = Scheduler(QueueConfig(max_active_tasks=1, max_tasks_per_user=3, max_tasks=5, max_queued_gpu_seconds=30),
+                              run_task, cost=lambda task: 4.0)
+        scheduler.submit(1, [make_task(job_id, 1) for job_id in range(3)])
+        errors = {}
+        for name, user_id, task_count, cost in [("user", 1, 1, 4.0), ("tasks", 2, 3, 12.0), ("gpu", 2, 2, 20.0)]:
+            with pytest.raises(QueueFullError) as info:
+                scheduler.admit(user_id, task_count, cost)
+            errors[name] = str(info.value)
+        # accepted: within all limits
+        scheduler.admit(2, 2, 8.0)
+        await scheduler.shutdown()
+        return errors
+
+    errors = asyncio.run(run())
+    assert errors["user"].startswith("You already have 3 task(s) in the queue and at most 3 are allowed.")
+    assert errors["tasks"] == "The queue is full right now, please try again later."
+    assert errors["gpu"].startswith("The queue is too long right now")
+
+
+def test_shutdown_cancels_running_tasks_without_starting_others():
+    async def run():
+        started = []
+
+        async def run_task(task):
+            started.append(task.job_id)
+            await asyncio.sleep(100)
+
+        scheduler = Scheduler(QueueConfig(max_active_tasks=2), run_task)
+        tasks = [make_task(job_id, user_id=job_id) for job_id in range(4)]
+        for task in tasks:
+            scheduler.submit(task.user_id, [task])
+        await asyncio.sleep(0)
+        running = [task.handle for task in tasks[:2]]
+
+        await scheduler.shutdown()
+        await asyncio.sleep(0)
+        return scheduler, started, running
+
+    scheduler, started, running = asyncio.run(run())
+    assert started == [0, 1]
+    assert all(handle.cancelled() for handle in running)
+    assert scheduler.active == {}
+    assert scheduler.pending_count == 2
+
+
+def test_global_order_predicts_the_start_order_with_lora_affinity():
+    async def run():
+        started = []
+        finished = {}
+
+        async def run_task(task):
+            started.append(task.job_id)
+            finished[task.job_id] = asyncio.Event()
+            await finished[task.job_id].wait()
+
+        # LoRA of each task, tasks with the LoRA of the previous task may skip ahead of other users
+        loras = {0: "a", 3: "b", 6: "b", 1: "b", 4: "b", 2: "a", 5: "a"}
+        scheduler = Scheduler(QueueConfig(max_active_tasks=1, affinity_window=2), run_task,
+                              affinity_key=lambda task: loras[task.job_id])
+        scheduler.submit(1, [make_task(0, 1), make_task(3, 1), make_task(6, 1)])
+        scheduler.submit(2, [make_task(1, 2), make_task(4, 2)])
+        scheduler.submit(3, [make_task(2, 3), make_task(5, 3)])
+        await asyncio.sleep(0)
+        predicted = [task.job_id for task in scheduler.global_order()]
+
+        while len(started) < len(loras):
+            finished[started[-1]].set()
+            await asyncio.sleep(0.01)
+        return predicted, started
+
+    predicted, started = asyncio.run(run())
+    assert predicted == started[1:]
+    # the tasks with LoRA "a" skipped ahead of the task of user 1
+    assert started[:3] == [0, 2, 5]
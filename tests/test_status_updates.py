@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+from comfyui_telegram_bot.config import StatusUpdatesConfig
+from comfyui_telegram_bot.status_updates import StatusUpdateScheduler
+
+
+def test_final_edit_waits_for_retry_after():
+    async def run():
+        scheduler = StatusUpdateScheduler(StatusUpdatesConfig(chat_interval=0.1))
+        sent = []
+        rate_limited = asyncio.Event()
+
+        async def edit_caption(caption, **kwargs):
+            if caption == "progress":
+                rate_limited.set()
+                raise RetryAfter(1)
+            sent.append((caption, time.monotonic()))
+
+        async def edit_media(**kwargs):
+            pass
+
+        updater = scheduler.create(1, edit_caption, edit_media)
+        updater.update_caption("progress")
+        await rate_limited.wait()
+        rate_limited_at = time.monotonic()
+        await updater.edit_caption("done")
+        return sent, rate_limited_at
+
+    sent, rate_limited_at = asyncio.run(run())
+    assert [caption for caption, _ in sent] == ["done"]
+    assert sent[0][1] - rate_limited_at >= 0.9
+
+
+def test_expired_chat_deadlines_are_dropped():
+    async def run():
+        scheduler = StatusUpdateScheduler(StatusUpdatesConfig(chat_interval=0.05))
+
+        async def edit(*args, **kwargs):
+            pass
+
+        first = scheduler.create(1, edit, edit)
+        await first.edit_caption("done")
+        assert 1 in scheduler._next_chat
+        await asyncio.sleep(0.1)
+        second = scheduler.create(2, edit, edit)
+        await second.close()
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert 1 not in scheduler._next_chat
+
+
+def test_other_messages_wait_for_retry_after_and_skip_errors():
+    async def run():
+        scheduler = StatusUpdateScheduler(StatusUpdatesConfig(chat_interval=0.01))
+        attempts = []
+
+        async def send_message():
+            attempts.append(time.monotonic())
+            if len(attempts) == 1:
+                raise RetryAfter(0.2)
+            return "message"
+
+        async def send_invalid():
+            raise BadRequest("Can't parse entities")
+
+        return await scheduler.send(1, send_message), await scheduler.send(1, send_invalid), attempts
+
+    message, invalid, attempts = asyncio.run(run())
+    assert message == "message"
+    assert invalid is None
+    assert attempts[1] - attempts[0] >= 0.2
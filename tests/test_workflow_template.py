@@ -0,0 +1,70 @@
+from copy import deepcopy
+from dataclasses import replace
+import json
+
+import pytest
+
+from comfyui_telegram_bot import config
+from comfyui_telegram_bot.workflow_template import compile_workflow
+
+VALUES = {
+    "prompt": "a \"quoted\" cat\nwith a new line",
+    "seed": 123456789,
+    "width": 1216,
+    "height": 832,
+    "batch_size": 2,
+    "cfg": 2.5,
+    "sampler": "dpmpp_2m",
+    "scheduler": "beta",
+    "steps": 28,
+    "lora": "flux-realism-lora.safetensors",
+    "lora_strength": 0.7,
+}
+
+
+def expected_nodes(workflow: dict, lora: bool, output_mode: str, save_images: bool) -> dict:
+    # the workflow as the bot built it before the templates, by editing a deep copy of the workflow file
+    workflow = deepcopy(workflow)
+    if lora:
+        workflow["55"]["inputs"]["lora_name"] = VALUES["lora"]
+        workflow["55"]["inputs"]["strength_model"] = VALUES["lora_strength"]
+    else:
+        workflow.pop("55")
+        workflow["22"]["inputs"]["model"] = ["54", 0]
+    if output_mode == "websocket":
+        workflow.pop("59")
+        if not save_images:
+            workflow.pop("52")
+    else:
+        workflow.pop("60")
+        workflow.pop("59" if save_images else "52")
+    workflow["54"]["inputs"]["unet_name"] = config.image_generation.model
+    workflow["10"]["inputs"]["vae_name"] = config.image_generation.vae
+    workflow["11"]["inputs"]["clip_name1"] = config.image_generation.clip_t5
+    workflow["11"]["inputs"]["clip_name2"] = config.image_generation.clip_l
+    workflow["6"]["inputs"]["text"] = VALUES["prompt"]
+    workflow["25"]["inputs"]["noise_seed"] = VALUES["seed"]
+    workflow["27"]["inputs"]["width"] = VALUES["width"]
+    workflow["27"]["inputs"]["height"] = VALUES["height"]
+    workflow["27"]["inputs"]["batch_size"] = VALUES["batch_size"]
+    workflow["26"]["inputs"]["guidance"] = VALUES["cfg"]
+    workflow["16"]["inputs"]["sampler_name"] = VALUES["sampler"]
+    workflow["17"]["inputs"]["scheduler"] = VALUES["scheduler"]
+    workflow["17"]["inputs"]["steps"] = VALUES["steps"]
+    return workflow
+
+
+@pytest.mark.parametrize("output_mode", ["history", "websocket"])
+@pytest.mark.parametrize("save_images", [True, False])
+@pytest.mark.parametrize("lora", [False, True])
+def test_rendered_workflow_matches_the_edited_workflow(lora, save_images, output_mode):
+    with open(config.image_generation.workflow_filepath) as file:
+        workflow = json.load(file)
+    image_generation = replace(config.image_generation, output_mode=output_mode, save_images=save_images)
+
+    template = compile_workflow(workflow, image_generation, lora=lora)
+
+    assert json.loads(template.render(VALUES)) == expected_nodes(workflow, lora, output_mode, save_images)
+    # the template does not change the workflow it was compiled from
+    with open(config.image_generation.workflow_filepath) as file:
+        assert workflow == json.load(file)